@@ -0,0 +1,49 @@
+import os
+import sys
+import subprocess
+
+# modules the PyTorch BNN experiments import, and the heavy packages they must not pull in
+CORE_MODULES = [
+    'modules.bnn.utils',
+    'modules.bnn.evaluation',
+    'modules.bnn.modules.linear',
+    'modules.bnn.modules.conv',
+    'datasets.gp_reg_dataset.gp_regression',
+    'datasets.toy_regression',
+]
+FORBIDDEN = ('tensorflow', 'gpflow', 'matplotlib', 'sklearn')
+
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(','.join(sorted({{m.split('.')[0] for m in sys.modules}} & set({forbidden!r}))))
+"""
+
+
+def import_time(module, root, repeats=3):
+    """
+    Best wall-clock time (s) over repeats of importing module in a fresh interpreter, and the
+    forbidden packages it loaded.
+    """
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, '-c', _SCRIPT.format(module=module, forbidden=FORBIDDEN)],
+            cwd=root, capture_output=True, text=True, check=True
+        ).stdout.split('\n')
+        times.append(float(out[0]))
+    return min(times), [m for m in out[1].split(',') if m]
+
+
+if __name__ == '__main__':
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    torch_time, _ = import_time('torch', root)
+    print(f"{'module':<42}{'import (s)':>12}{'over torch (s)':>16}  heavy imports")
+    failed = False
+    for module in CORE_MODULES:
+        seconds, loaded = import_time(module, root)
+        failed = failed or bool(loaded)
+        print(f"{module:<42}{seconds:>12.3f}{seconds - torch_time:>16.3f}  {', '.join(loaded) or '-'}")
+    sys.exit(1 if failed else 0)
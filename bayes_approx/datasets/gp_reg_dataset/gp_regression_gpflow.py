@@ -0,0 +1,64 @@
+import numpy as np
+import tensorflow as tf
+
+from datasets.gp_reg_dataset.gp_regression import normalise_data, unnormalise_data
+from datasets.gp_reg_dataset.gp_regression_plots import plot_regression
+
+
+def gpflow_get_regression_results(m, x, train, lik_var=None, unnormalise=True):
+    y_pred_mean, y_pred_var = m.predict_f(x)
+    y_pred_std = y_pred_var**0.5
+    if lik_var is not None:
+        # total uncertainty: here the preditive std needs to count for output noise variance
+        y_pred_std = (y_pred_std**2 + lik_var)**0.5
+    if unnormalise:
+        y_pred_mean = unnormalise_data(y_pred_mean, train.y_mean, train.y_std)
+        y_pred_std = unnormalise_data(y_pred_std, 0.0, train.y_std)
+    return y_pred_mean, y_pred_std
+
+
+def gpflow_plot_bnn_pred_post(m, train, test, lik_var, title=None, exp_name=None):
+    if title is None:
+        title = 'BNN approximate posterior (MFVI)'
+    # predict mean and variance of latent GP at test points
+    x_test_norm = normalise_data(test.x, train.x_mean, train.x_std)
+    y_pred_mean_norm, y_pred_var_noiseless_norm = m.predict_f(x_test_norm)
+    y_pred_mean = unnormalise_data(y_pred_mean_norm, train.y_mean, train.y_std)
+    y_pred_std_noiseless = unnormalise_data(np.sqrt(y_pred_var_noiseless_norm), 0.0, train.y_std)
+
+    # generate 10 samples from posterior
+    y_pred_mean_samples_norm = m.predict_f_samples(x_test_norm, 10)  # shape (10, 100, 1)
+    y_pred_mean_samples = unnormalise_data(y_pred_mean_samples_norm, train.y_mean, train.y_std)
+
+    model_noise_std = unnormalise_data(lik_var**0.5, 0.0, train.y_std)
+    y_pred_std = np.sqrt(y_pred_std_noiseless**2 + model_noise_std**2)
+
+    plot_regression(
+        train, test, y_pred_mean, y_pred_std_noiseless, y_pred_std, y_pred_mean_samples, title, exp_name
+    )
+    print(f'model_std: {model_noise_std}, pred_std: {y_pred_std_noiseless.mean()}')
+
+
+def gpflow_test_step(m, test, train, loss_func='mse', lik_var=None):
+    x_test_norm = normalise_data(test.x, train.x_mean, train.x_std)
+    y_pred_mean, y_pred_std = gpflow_get_regression_results(
+        m, x_test_norm, train, lik_var
+    )
+    if loss_func == 'mse':
+        mse = tf.keras.losses.MeanSquaredError()
+        loss = mse(y_pred_mean, test.y).numpy()
+        print('\nTest set: MSE: {}'.format(loss))
+    elif loss_func == 'gnll':
+        loss = np.mean(0.5 * (2*np.log(y_pred_std) + (y_pred_mean - test.y)**2 / y_pred_std**2 + np.log(2*np.pi)))
+        print('\nTest set: GNLL: {}'.format(loss))
+    return loss
+
+
+def gpflow_mse_train(m, train, lik_var=None):
+    y_pred_mean, _ = gpflow_get_regression_results(
+        m, train.x, None, lik_var, False
+    )
+    mse = tf.keras.losses.MeanSquaredError()
+    loss = mse(y_pred_mean, train.y).numpy()
+    print('\nTrain set: MSE: {}'.format(loss))
+    return loss
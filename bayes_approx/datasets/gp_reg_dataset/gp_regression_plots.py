@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+
+from datasets.gp_reg_dataset.gp_regression import (
+    device, to_numpy, normalise_data, unnormalise_data, get_regression_results
+)
+
+
+def plot_regression(normal_train, test, y_pred_mean, y_pred_std_noiseless,
+                    y_pred_std, y_pred_mean_samples, title='', exp_name=None):
+    x_train = unnormalise_data(normal_train.x, normal_train.x_mean, normal_train.x_std)
+    y_train = unnormalise_data(normal_train.y, normal_train.y_mean, normal_train.y_std)
+
+    # first for the total uncertainty (model/epistemic + data/aleatoric)
+    plt.figure(figsize=(12, 6))
+    plt.plot(x_train, y_train, "kx", mew=2, label='noisy sample points')
+    plt.plot(test.x, y_pred_mean, "C0", lw=2, label='prediction mean')
+    plt.fill_between(
+        test.x[:,0],
+        y_pred_mean[:,0] - 1.96 * y_pred_std[:,0],  # 95% confidence interval
+        y_pred_mean[:,0] + 1.96 * y_pred_std[:,0],
+        # y_pred_mean - 1.96 * y_pred_std,  # 95% confidence interval
+        # y_pred_mean + 1.96 * y_pred_std,
+        color="C0",
+        alpha=0.2,
+        label='total uncertainity'
+    )
+    plt.fill_between(
+        test.x[:,0],
+        y_pred_mean[:,0] - 1.96 * y_pred_std_noiseless[:,0],  # 95% confidence interval
+        y_pred_mean[:,0] + 1.96 * y_pred_std_noiseless[:,0],
+        # y_pred_mean - 1.96 * y_pred_std_noiseless,  # 95% confidence interval
+        # y_pred_mean + 1.96 * y_pred_std_noiseless,
+        color="b",
+        alpha=0.2,
+        label='model uncertainity'
+    )
+
+    plt.plot(test.x, np.array(y_pred_mean_samples)[:,:,0].T, "C0", linewidth=0.5)
+
+    plt.plot(test.x, test.y, color='orange', label='sample function')
+    plt.legend()
+    plt.title(title)
+    if exp_name is not None:
+        plt.savefig(f'./figures/{exp_name}_out.png', bbox_inches='tight')
+    plt.show()
+
+
+def plot_bnn_pred_post(model, predict, normal_train, test, log_lik_var,
+                       title=None, exp_name=None, device=device):
+    if title is None:
+        title = 'BNN approximate posterior (MFVI)'
+    # plot the BNN prior in function space
+    x_test_norm = normalise_data(test.x, normal_train.x_mean, normal_train.x_std)
+    x_test_norm = torch.tensor(x_test_norm,).float().to(device)
+
+    y_pred_mean, y_pred_std_noiseless = get_regression_results(
+        model, x_test_norm, predict, normal_train
+    )
+    y_pred_mean_samples = [
+        get_regression_results(model, x_test_norm, predict, normal_train, K=1)[0]
+        for _ in range(10)
+    ]
+    model_noise_std = unnormalise_data(to_numpy(torch.exp(0.5*log_lik_var)), 0.0, normal_train.y_std)
+    y_pred_std = np.sqrt(y_pred_std_noiseless**2 + model_noise_std**2)
+    plot_regression(
+        normal_train, test, y_pred_mean, y_pred_std_noiseless, y_pred_std, y_pred_mean_samples, title, exp_name
+    )
+    print(f'model_std: {model_noise_std}, pred_std: {y_pred_std_noiseless.mean()}')
@@ -1,7 +1,6 @@
 import torchvision.datasets as d
 import torchvision.transforms as t
 import torch
-import matplotlib.pyplot as plt
 
 
 def import_n_mnist(batch_size_train, batch_size_test):
@@ -29,6 +28,7 @@ def import_n_mnist(batch_size_train, batch_size_test):
 
 
 def plot_examples(test_loader):
+    import matplotlib.pyplot as plt  # imported on first use
     examples = enumerate(test_loader)
     batch_idx, (example_data, example_targets) = next(examples)
 
@@ -0,0 +1,31 @@
+import math
+import torch
+
+
+class TensorLoader:
+    """Minibatch loader over a dataset holding its (normalised) data as arrays x and y.
+       The arrays are converted to float tensors on the device once, and shuffled minibatches
+       are taken by indexing with a random permutation, so there is no per-example
+       __getitem__ or collate step. Can be used in place of DataLoader(dataset, batch_size,
+       shuffle): it has the same len() and .dataset and yields the same (x, y) batches.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, device='cpu'):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.x = torch.as_tensor(dataset.x, device=device).float()
+        self.y = torch.as_tensor(dataset.y, device=device).float()
+
+    def __len__(self):
+        return math.ceil(self.x.shape[0] / self.batch_size)
+
+    def __iter__(self):
+        num_data = self.x.shape[0]
+        if not self.shuffle:
+            for start in range(0, num_data, self.batch_size):
+                yield self.x[start:start + self.batch_size], self.y[start:start + self.batch_size]
+            return
+        index = torch.randperm(num_data, device=self.x.device)
+        for start in range(0, num_data, self.batch_size):
+            batch_index = index[start:start + self.batch_size]
+            yield self.x[batch_index], self.y[batch_index]
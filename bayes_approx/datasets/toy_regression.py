@@ -1,8 +1,9 @@
 import numpy as np
 import math
 import torch
-from torch.utils.data import Dataset, DataLoader
-import matplotlib.pyplot as plt
+from torch.utils.data import Dataset
+
+from datasets.tensor_loader import TensorLoader
 
 
 def to_numpy(x):
@@ -62,7 +63,8 @@ class regression_data(Dataset):
             self.y = normalise_data(self.y, self.y_mean, self.y_std)
 
 
-def create_regression_dataset(N_data=100, noise_std=0.1):
+def create_regression_dataset(N_data=100, noise_std=0.1, device='cpu'):
+    import matplotlib.pyplot as plt  # imported on first use
     x_train, y_train = gen_data(N_data, ground_truth_func, noise_std)
     normalised_train = regression_data(x_train, y_train)
 
@@ -76,13 +78,13 @@ def create_regression_dataset(N_data=100, noise_std=0.1):
     plt.title('ground-truth function')
     plt.show()
 
-    train_loader = DataLoader(normalised_train, batch_size=64, shuffle=True)
-    test_loader = DataLoader(test, batch_size=1000, shuffle=True)
+    train_loader = TensorLoader(normalised_train, batch_size=64, shuffle=True, device=device)
+    test_loader = TensorLoader(test, batch_size=1000, shuffle=True)
     return train_loader, test_loader, normalised_train, test
 
 
 def get_regression_results(net, x, K, predict, dataset, log_noise_var=None):
-    y_pred_mean, y_pred_std = predict(net, x, K=K)  # shape (K, N_test, y_dim)
+    y_pred_mean, y_pred_std, *_ = predict(net, x, K=K)  # shape (K, N_test, y_dim)
     if log_noise_var is not None:
         # total uncertainty: here the preditive std needs to count for output noise variance
         y_pred_std = (y_pred_std**2 + torch.exp(log_noise_var)).sqrt()
@@ -93,6 +95,7 @@ def get_regression_results(net, x, K, predict, dataset, log_noise_var=None):
 
 
 def plot_regression(normal_train, test, y_pred_mean, y_pred_std_noiseless, y_pred_std, title=''):
+    import matplotlib.pyplot as plt
     x_train = unnormalise_data(normal_train.x, normal_train.x_mean, normal_train.x_std)
     y_train = unnormalise_data(normal_train.y, normal_train.y_mean, normal_train.y_std)
     plt.plot(x_train, y_train, 'ro', label='data')
@@ -126,6 +129,7 @@ def plot_bnn_pred_post(model, predict, normal_train, test, log_noise_var, noise_
 
 
 def plot_training_loss(logs):
+    import matplotlib.pyplot as plt
     _, (ax1, ax2) = plt.subplots(1, 2, figsize=(8, 4))
     ax1.plot(np.arange(logs.shape[0]), logs[:, 0], 'r-')
     ax2.plot(np.arange(logs.shape[0]), logs[:, 1], 'r-')
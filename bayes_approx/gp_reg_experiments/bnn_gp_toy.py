@@ -1,8 +1,6 @@
 import torch
 import torch.nn as nn
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.model_selection import KFold
 
 import os
 import sys
@@ -14,18 +12,25 @@ sys.path.insert(0, parentdir)
 
 from datasets.gp_reg_dataset import gp_regression as d
 from modules.bnn.modules.linear import make_linear_bnn
+from modules.bnn.modules.ensemble import SampledEnsemble
+from modules.bnn.evaluation import evaluate
 from modules.bnn.modules.loss import GaussianKLLoss, nELBO
+from modules.bnn.stacked import StackedBNN, stacked_training_loop
+from modules.bnn.cross_val import run_cross_val
 from modules.bnn.utils import *
 
 
 def full_training(exp_name=None, n_epochs=10000,
                   num_layers=2, h_dim=50, activation='relu', init_std=0.05,
-                  likelihood_std=0.05, prior_weight_std=1.0, prior_bias_std=1.0):
+                  likelihood_std=0.05, prior_weight_std=1.0, prior_bias_std=1.0, sampling='weight',
+                  resume=False, stopping=None):
     torch.manual_seed(1)
     if exp_name == 'hyper':
         exp_name = (f'BNN_GPtoyreg_nl{num_layers}_hdim{h_dim}_likstd{likelihood_std}'
                     + f'_pws{prior_weight_std}_pbs{prior_bias_std}')
-    exp_name = uniquify(exp_name)
+    if not resume:
+        # a resumed run continues the checkpoint of the same experiment name
+        exp_name = uniquify(exp_name)
     # import dataset
     train_loader, test_loader, train, test, noise_std = d.create_regression_dataset()
 
@@ -41,6 +46,7 @@ def full_training(exp_name=None, n_epochs=10000,
                     'prior_bias_std': prior_bias_std,
                     'sqrt_width_scaling': True,
                     'init_std': init_std,
+                    'sampling': sampling,
                     'device': device}
     model = make_linear_bnn(layer_sizes, activation, **layer_kwargs)
     if torch.cuda.is_available():
@@ -63,7 +69,7 @@ def full_training(exp_name=None, n_epochs=10000,
 
     logs = training_loop(
         model, n_epochs, opt, lr_sch, nelbo, train_loader, test_loader, log_lik_var,
-        d.mse_test_step, train, exp_name, device
+        d.mse_test_step, train, exp_name, device, resume=resume, stopping=stopping
     )
     # plot_training_loss(logs)
 
@@ -74,7 +80,7 @@ def full_training(exp_name=None, n_epochs=10000,
 
 def hyper_training_iter(train_loader, test_loader, train, test,
                         num_layers=2, h_dim=50, activation='relu', init_std=0.1,
-                        likelihood_std=0.1, prior_weight_std=1.0, prior_bias_std=1.0):
+                        likelihood_std=0.1, prior_weight_std=1.0, prior_bias_std=1.0, stopping=None):
     n_epochs = 16000
 
     # create bnn
@@ -90,8 +96,9 @@ def hyper_training_iter(train_loader, test_loader, train, test,
                     'sqrt_width_scaling': True,
                     'init_std': init_std,
                     'device': device}
-    model = make_linear_bnn(layer_sizes, activation, **layer_kwargs)
-    normal_lik_std = torch.cuda.FloatTensor(d.normalise_data(likelihood_std, 0, train.y_std))
+    # one flat tensor per parameter group keeps the per-step cost flat in the number of layers
+    model = make_linear_bnn(layer_sizes, activation, flat_params=True, **layer_kwargs)
+    normal_lik_std = torch.as_tensor(d.normalise_data(likelihood_std, 0, train.y_std), device=device).float()
     log_lik_var = torch.ones(size=(), device=device)*torch.log(normal_lik_std**2)  # Gaussian likelihood -4.6 == std 0.1
     # print("BNN architecture: \n", model)
 
@@ -110,7 +117,7 @@ def hyper_training_iter(train_loader, test_loader, train, test,
 
     logs = training_loop(
         model, n_epochs, opt, lr_sch, nelbo, train_loader, test_loader, log_lik_var,
-        d.mse_test_step, train, None, device
+        d.mse_test_step, train, None, device, stopping=stopping
     )
     # plot_training_loss(logs)
 
@@ -119,7 +126,43 @@ def hyper_training_iter(train_loader, test_loader, train, test,
     return d.mse_test_step(model, test_loader, train, predict, log_lik_var), logs[-1][1]
 
 
-def bnn_cross_val():
+def bnn_cv_job(config, fold, n_splits, seed):
+    """
+    Train and validate one hyperparameter config on one fold, see run_cross_val.
+    """
+    train_loader, val_loader, normalised_train, val = d.regression_fold(fold, n_splits, seed)
+    val_loss, elbo = hyper_training_iter(
+        train_loader, val_loader, normalised_train, val, h_dim=50, activation='relu', **config
+    )
+    return {'val_mse': float(val_loss), 'elbo': float(elbo)}
+
+
+def bnn_cross_val(ledger='bayes_approx/results/gp_bnn/cv_ledger.jsonl', num_workers=None):
+    """
+    5-fold cross validation of the hyperparameter grid on a process pool. Completed
+    (config, fold) results are kept in the ledger, rerun to resume an interrupted sweep.
+    """
+    grid = {'init_std': [0.05, 'prior'],
+            'likelihood_std': [0.02, 0.01],
+            'num_layers': [5, 4],
+            ('prior_weight_std', 'prior_bias_std'): [(0.5, 0.5), (0.5, 2.0), (5.0, 10.0)]}
+
+    best_loss = float('inf')
+    for config, result in run_cross_val(bnn_cv_job, grid, 5, ledger, num_workers):
+        print(f'Model: {config}, CV Loss={result["val_mse"]}')
+        if result['val_mse'] < best_loss:
+            best_model = config
+            best_loss = result['val_mse']
+    print(f'Best CV Loss:{best_loss}. Best Model:{best_model}')
+
+
+def bnn_stacked_cross_val(n_epochs=16000, h_dim=50, activation='relu'):
+    """
+    bnn_cross_val with every configuration and fold of the same depth trained together
+    as one StackedBNN, so the grid costs a few vectorised runs instead of one run per model.
+    """
+    from sklearn.model_selection import KFold  # only needed for cross validation
+
     init_std_list = [0.05, 'prior']
     lik_var_list = [0.02, 0.01]
     num_layers_list = [5, 4]
@@ -131,38 +174,59 @@ def bnn_cross_val():
     (train_loader_list, val_loader_list, tesst_loader,
         normalised_train_list, val_list, test, noise_std) = d.create_regression_dataset_kf(kf)
 
-    completed_cvs = 0
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    x_dim, y_dim = 1, 1
+    if activation == 'relu':
+        activation = nn.ReLU()
+    elif activation == 'tanh':
+        activation = nn.Tanh()
+    gnll_loss = nn.GaussianNLLLoss(full=True, reduction='sum')
+    kl_loss = GaussianKLLoss()
+    nelbo = nELBO(nll_loss=gnll_loss, kl_loss=kl_loss)
 
     best_loss = float('inf')
-    for init_std in init_std_list:
-        for lik_var in lik_var_list:
-            for num_layers in num_layers_list:
-                for p_w_std, p_b_std in prior_std_list:
-                    if completed_cvs > 0:
-                        completed_cvs -= 1
-                        continue
-                    t_val_loss = 0
-                    t_elbo = 0
-                    print(f'Current Model: lv={lik_var}, nl={num_layers}, pws={p_w_std}, pbs={p_b_std}')
-                    for i in range(n_splits):
-                        val_loss, elbo = hyper_training_iter(
-                            train_loader_list[i], val_loader_list[i],
-                            normalised_train_list[i], val_list[i],
-                            num_layers=num_layers, h_dim=50, activation='relu',
-                            init_std=init_std, likelihood_std=lik_var,
-                            prior_weight_std=p_w_std, prior_bias_std=p_b_std
-                        )
-                        t_val_loss += val_loss/n_splits
-                        t_elbo += elbo/n_splits
-                    print(f'CV Loss={t_val_loss}')
-                    if t_val_loss < best_loss:
-                        best_model = {'init_std': init_std, 'likelihood var': lik_var,
-                                      'num_layers': num_layers,
-                                      'prior w std': p_w_std, 'prior b std': p_b_std}
-                        best_loss = t_val_loss
-                    print(f'Best CV Loss:{best_loss}. Best Model:{best_model}')
-                    with open('bayes_approx/results/gp_bnn/new_auto_cv.txt', 'a') as f:
-                        f.write(f'{init_std} {lik_var} {num_layers} {p_w_std} {p_b_std} {t_val_loss} {t_elbo} \n')
+    for num_layers in num_layers_list:
+        layer_sizes = [x_dim] + [h_dim for _ in range(num_layers)] + [y_dim]
+        configs = [(init_std, lik_var, p_w_std, p_b_std)
+                   for init_std in init_std_list for lik_var in lik_var_list
+                   for p_w_std, p_b_std in prior_std_list]
+        models, loaders, log_lik_vars = [], [], []
+        for init_std, lik_var, p_w_std, p_b_std in configs:
+            for i in range(n_splits):
+                models.append(make_linear_bnn(
+                    layer_sizes, activation, prior_weight_std=p_w_std, prior_bias_std=p_b_std,
+                    sqrt_width_scaling=True, init_std=init_std, device=device
+                ))
+                loaders.append(train_loader_list[i])
+                normal_lik_std = d.normalise_data(lik_var, 0, normalised_train_list[i].y_std)
+                log_lik_vars.append(np.log(normal_lik_std**2))
+        log_lik_vars = torch.tensor(np.array(log_lik_vars), dtype=torch.float, device=device).reshape(-1)
+        print(f'Training {len(models)} models with nl={num_layers}')
+
+        stacked = StackedBNN(models, kl_loss)
+        opt = torch.optim.Adam(stacked.parameters(), lr=1e-3)
+        lr_sch = torch.optim.lr_scheduler.StepLR(opt, 7000, gamma=0.15)
+        logs = stacked_training_loop(stacked, n_epochs, opt, lr_sch, nelbo, loaders, log_lik_vars, device)
+        models = stacked.unstack()
+
+        for c, (init_std, lik_var, p_w_std, p_b_std) in enumerate(configs):
+            t_val_loss = 0
+            t_elbo = 0
+            for i in range(n_splits):
+                m = c*n_splits + i
+                t_val_loss += d.mse_test_step(
+                    models[m], val_loader_list[i], normalised_train_list[i], predict, log_lik_vars[m]
+                )/n_splits
+                t_elbo += logs[-1][m][1]/n_splits
+            print(f'Model: lv={lik_var}, nl={num_layers}, pws={p_w_std}, pbs={p_b_std}, CV Loss={t_val_loss}')
+            if t_val_loss < best_loss:
+                best_model = {'init_std': init_std, 'likelihood var': lik_var,
+                              'num_layers': num_layers,
+                              'prior w std': p_w_std, 'prior b std': p_b_std}
+                best_loss = t_val_loss
+            with open('bayes_approx/results/gp_bnn/new_auto_cv.txt', 'a') as f:
+                f.write(f'{init_std} {lik_var} {num_layers} {p_w_std} {p_b_std} {t_val_loss} {t_elbo} \n')
+    print(f'Best CV Loss:{best_loss}. Best Model:{best_model}')
 
 
 def load_test_model(exp_name=None, n_epochs=None,
@@ -195,11 +259,13 @@ def load_test_model(exp_name=None, n_epochs=None,
     model = load_model(model, exp_name)
     logs = load_logs(exp_name)
     plot_training_loss_together(logs, exp_name=exp_name)
-    d.plot_bnn_pred_post(model, predict, train, test, log_lik_var, None, exp_name, device)
-    d.mse_test_step(model, test_loader, train, predict, log_lik_var)
-    d.gnll_test_step(model, test_loader, train, predict, log_lik_var)
-    d.mse_train(model, train_loader, predict, log_lik_var)
-    d.gnll_train(model, train_loader, predict, log_lik_var)
+    # freeze one set of posterior samples so the plot and every metric see the same functions
+    ensemble = SampledEnsemble(model, num_samples=50)
+    d.plot_bnn_pred_post(ensemble, predict, train, test, log_lik_var, None, exp_name, device)
+    results = evaluate(ensemble, {'test': (test_loader, train), 'train': (train_loader, None)},
+                       ['mse', 'gnll', 'calibration'], K=50, log_lik_var=log_lik_var, device=device)
+    for name, metrics in results.items():
+        print(f'\n{name} set: ' + ', '.join(f'{k.upper()}: {v:.4f}' for k, v in metrics.items()))
 
 
 if __name__ == "__main__":
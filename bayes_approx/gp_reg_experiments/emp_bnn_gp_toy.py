@@ -12,6 +12,8 @@ sys.path.insert(0, parentdir)
 
 from datasets.gp_reg_dataset import gp_regression as d
 from modules.bnn.modules.emp_linear import make_linear_emp_bnn
+from modules.bnn.modules.ensemble import SampledEnsemble
+from modules.bnn.evaluation import evaluate
 from modules.bnn.modules.loss import GaussianKLLoss, nELBO
 from modules.bnn.utils import *
 
@@ -105,11 +107,13 @@ def load_test_model(exp_name=None,
     model = load_model(model, exp_name)
     logs = load_logs(exp_name)
     plot_training_loss_together(logs, exp_name=exp_name)
-    d.plot_bnn_pred_post(model, predict, train, test, log_lik_var, None, exp_name, device)
-    d.mse_test_step(model, test_loader, train, predict, log_lik_var)
-    d.gnll_test_step(model, test_loader, train, predict, log_lik_var)
-    d.mse_train(model, train_loader, predict, log_lik_var)
-    d.gnll_train(model, train_loader, predict, log_lik_var)
+    # freeze one set of posterior samples so the plot and every metric see the same functions
+    ensemble = SampledEnsemble(model, num_samples=50)
+    d.plot_bnn_pred_post(ensemble, predict, train, test, log_lik_var, None, exp_name, device)
+    results = evaluate(ensemble, {'test': (test_loader, train), 'train': (train_loader, None)},
+                       ['mse', 'gnll', 'calibration'], K=50, log_lik_var=log_lik_var, device=device)
+    for name, metrics in results.items():
+        print(f'\n{name} set: ' + ', '.join(f'{k.upper()}: {v:.4f}' for k, v in metrics.items()))
 
 
 if __name__ == "__main__":
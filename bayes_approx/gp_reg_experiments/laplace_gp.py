@@ -15,6 +15,7 @@ sys.path.insert(0, parentdir)
 
 from external.scalemarglik import marglik_optimization
 from modules.bnn.utils import uniquify, to_numpy
+from modules.bnn.cross_val import run_cross_val
 
 from datasets.gp_reg_dataset import gp_regression as d
 
@@ -152,6 +153,37 @@ def full_training(exp_name=None, laplace='full', n_epochs=500, num_layers=2, h_d
     return test_mse, test_gnll, train_mse, train_gnll, margliks[-1], losses[-1]
 
 
+def laplace_cv_job(config, fold, n_splits, seed):
+    """
+    Fit one config (laplace, n_epochs, num_layers, h_dim) on one fold and validate it, see run_cross_val.
+    """
+    train_loader, val_loader, train, val = d.regression_fold(fold, n_splits, seed)
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    x_dim, y_dim = 1, 1
+    layer_sizes = [x_dim] + [config['h_dim'] for _ in range(config['num_layers'])] + [y_dim]
+    model = make_linear_nn(layer_sizes, config['num_layers']).to(device)
+    laplace = FullLaplace if config['laplace'] == 'full' else KronLaplace
+
+    lap, model, margliks, losses = marglik_optimization(
+        model, train_loader, likelihood='regression', sigma_noise_init=0.05, backend=BackPackGGN,
+        laplace=laplace, n_epochs=config['n_epochs']
+    )
+    log_lik_var = torch.log(lap.sigma_noise)
+    return {'val_mse': float(d.mse_test_step(lap, val_loader, train, predict, log_lik_var)),
+            'val_gnll': float(d.gnll_test_step(lap, val_loader, train, predict, log_lik_var)),
+            'marglik': float(margliks[-1])}
+
+
+def laplace_cross_val(ledger='bayes_approx/results/gp_laplacebnn/cv_ledger.jsonl', num_workers=None):
+    """
+    5-fold cross validation of the Laplace hyperparameter grid on a process pool. Completed
+    (config, fold) results are kept in the ledger, rerun to resume an interrupted sweep.
+    """
+    grid = {'laplace': ['full', 'kron'], 'n_epochs': [300, 600], 'num_layers': [2, 3, 4, 5], 'h_dim': [50]}
+    for config, result in run_cross_val(laplace_cv_job, grid, 5, ledger, num_workers):
+        print(f'Model: {config}, CV result: {result}')
+
+
 if __name__ == '__main__':
     x = full_training(exp_name='hyper', n_epochs=300, num_layers=2, laplace='full', activation='relu')
     print(x)
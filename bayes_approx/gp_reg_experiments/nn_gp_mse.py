@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.model_selection import KFold
 
 import os
 import sys
@@ -15,6 +14,7 @@ sys.path.insert(0, parentdir)
 from datasets.gp_reg_dataset import gp_regression as d
 from modules.bnn.modules.nnlinear import make_linear_nn
 from modules.bnn.utils import *
+from modules.bnn.cross_val import run_cross_val
 
 # OPTIMISE = True
 
@@ -138,32 +138,31 @@ def hyper_training_iter(train_loader, test_loader, train, test, num_layers, h_di
     return d.mse_test_step(model, test_loader, train, predict)
 
 
-def nn_cross_val():
-    n_splits = 5
-    weight_decay_list = [1e-6, 1e-4]
-    num_layers_list = [1, 2, 3, 4]
-    height_list = [50]
-    kf = KFold(n_splits=n_splits, shuffle=True)
+def nn_cv_job(config, fold, n_splits, seed):
+    """
+    Train and validate one hyperparameter config on one fold, see run_cross_val.
+    """
+    train_loader, val_loader, normalised_train, val = d.regression_fold(fold, n_splits, seed)
+    return float(hyper_training_iter(
+        train_loader, val_loader, normalised_train, val,
+        config['num_layers'], config['height'], config['weight_decay']
+    ))
 
-    (train_loader_list, val_loader_list, test_loader,
-        normalised_train_list, val_list, test, noise_std) = d.create_regression_dataset_kf(kf)
+
+def nn_cross_val(ledger='bayes_approx/results/gp_nn/cv_ledger.jsonl', num_workers=None):
+    """
+    5-fold cross validation of the hyperparameter grid on a process pool. Completed
+    (config, fold) results are kept in the ledger, rerun to resume an interrupted sweep.
+    """
+    grid = {'weight_decay': [1e-6, 1e-4], 'num_layers': [1, 2, 3, 4], 'height': [50]}
 
     best_loss = float('inf')
-    for weight_decay in weight_decay_list:
-        for num_layers in num_layers_list:
-            for height in height_list:
-                t_val_loss = 0
-                for i in range(n_splits):
-                    t_val_loss += hyper_training_iter(
-                        train_loader_list[i], val_loader_list[i],
-                        normalised_train_list[i], val_list[i],
-                        num_layers, height, weight_decay
-                    )/n_splits
-                print(f'Current Model CV Result: wd={weight_decay}, nl={num_layers}, h={height}, cv_loss={t_val_loss}')
-                if t_val_loss < best_loss:
-                    best_model = {'weight_decay': weight_decay, 'num_layers': num_layers, 'height': height}
-                    best_loss = t_val_loss
-                print(f'Best CV Loss:{best_loss}. Best Model:{best_model}')
+    for config, t_val_loss in run_cross_val(nn_cv_job, grid, 5, ledger, num_workers):
+        print(f'Current Model CV Result: {config}, cv_loss={t_val_loss}')
+        if t_val_loss < best_loss:
+            best_model = config
+            best_loss = t_val_loss
+    print(f'Best CV Loss:{best_loss}. Best Model:{best_model}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,45 @@
+import torch
+import torch.nn as nn
+
+import os
+import sys
+import inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from modules.bnn.modules.linear import make_linear_bnn, NOISE_MODES
+from modules.bnn.utils import predict
+
+
+def noise_variance(K_list=(2, 4, 8, 16, 32, 64), n_repeats=200,
+                   num_layers=2, h_dim=50, init_std=0.1, device='cpu'):
+    """
+    Variance (over n_repeats calls of predict) of the predictive mean and std estimates on the
+    toy regression input range, averaged over the inputs, for every noise source and K.
+    """
+    torch.manual_seed(1)
+    layer_sizes = [1] + [h_dim for _ in range(num_layers)] + [1]
+    model = make_linear_bnn(layer_sizes, activation=nn.ReLU(), init_std=init_std).to(device)
+    x = torch.linspace(-2, 2, 100).unsqueeze(1)
+
+    results = {}
+    with torch.no_grad():
+        for noise in NOISE_MODES:
+            for K in K_list:
+                means, stds = zip(*[predict(model, x, K=K, device=device, noise=noise)
+                                    for _ in range(n_repeats)])
+                results[(noise, K)] = (torch.stack(means).var(0).mean().item(),
+                                       torch.stack(stds).var(0).mean().item())
+    return results
+
+
+if __name__ == '__main__':
+    K_list = (2, 4, 8, 16, 32, 64)
+    results = noise_variance(K_list)
+    print(f"{'noise':<12}{'K':>4}{'var(mean)':>14}{'var(std)':>14}")
+    for noise in NOISE_MODES:
+        for K in K_list:
+            var_mean, var_std = results[(noise, K)]
+            print(f"{noise:<12}{K:>4}{var_mean:>14.3e}{var_std:>14.3e}")
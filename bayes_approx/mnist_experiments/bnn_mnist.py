@@ -5,8 +5,10 @@ import numpy as np
 # import torchvision
 
 from modules.bnn.modules.linear import make_linear_bnn
+from modules.bnn.modules.conv import make_conv_bnn
 from modules.bnn.modules.loss import GaussianKLLoss, nELBO
 from modules.bnn.utils import to_numpy
+from modules.bnn.evaluation import evaluate
 
 import datasets.mnist as d
 
@@ -22,19 +24,10 @@ def train_step(model, opt, nelbo, dataloader, device):
         opt.zero_grad()
         loss.backward()
         opt.step()
-        tloss += loss; tnll += nll; tkl += kl
+        tloss += loss.detach().sum(); tnll += nll.detach().sum(); tkl += kl.detach().sum()
     return tloss, tnll, tkl
 
 
-def predict(model, x_test, K=1):  # Monte Carlo sampling using K samples
-    y_pred = []
-    for _ in range(K):
-        y_pred.append(model(x_test))
-    # shape (K, batch_size, y_dim) or (batch_size, y_dim) if K = 1
-    y_pred = torch.stack(y_pred, dim=0).squeeze(0)
-    return y_pred.mean(0), y_pred.std(0)
-
-
 if __name__ == "__main__":
     torch.manual_seed(1)
 
@@ -53,8 +46,14 @@ if __name__ == "__main__":
                     'prior_bias_std': 1.0,
                     'sqrt_width_scaling': False,
                     'init_std': 0.05,
+                    'sampling': 'local',
                     'device': device}
-    model = make_linear_bnn(layer_sizes, activation=activation, **layer_kwargs)
+    conv = True  # convolutional BNN, about two thirds of the parameters of the fully connected one
+    if conv:
+        model = make_conv_bnn((1, 28, 28), [16, 32, 32], [64, y_dim], kernel_size=5,
+                              activation=activation, **layer_kwargs)
+    else:
+        model = make_linear_bnn(layer_sizes, activation=activation, **layer_kwargs)
     log_noise_var = torch.ones(size=(), device=device)*-3.0  # Gaussian likelihood
     print("BNN architecture: \n", model)
 
@@ -79,16 +78,10 @@ if __name__ == "__main__":
 
         if (i+1) % 1 == 0:
             model.eval()
-            test_loss = 0
-            correct = 0
-            with torch.no_grad():
-                for x_test, y_test in test_loader:
-                    m, v = predict(model, x_test.reshape((-1,784)), K=50)
-                    pred = m.max(1, keepdim=True)[1]
-                    correct += pred.eq(y_test.view_as(pred)).sum()
-            print('\nTest set: Accuracy: {}/{} ({:.0f}%)\n'.format(
-                correct, len(test_loader.dataset),
-                100. * correct / len(test_loader.dataset)))
+            results = evaluate(model, {'test': (test_loader, None)}, ['accuracy', 'nll', 'calibration'],
+                               K=50, task='classification', device=device)['test']
+            print('\nTest set: Accuracy: {:.2f}%, NLL: {:.4f}, ECE: {:.4f}\n'.format(
+                100. * results['accuracy'], results['nll'], results['calibration']))
 
             # lr = optimizer._decayed_lr(tf.float32)
             # print("Step: {:.0f}, Learning Rate: {:.2e}, ELBO: {:.4e}, Accuracy: {:.4f}%".format(step, lr, elbo, acc))
@@ -1,11 +1,14 @@
 import torch
 import torch.nn as nn
-# import numpy as np
+import torch.nn.functional as F
+import numpy as np
 # import matplotlib.pyplot as plt
 
 from modules.bnn.modules.emp_linear import make_linear_emp_bnn
+from modules.bnn.modules.conv import make_conv_emp_bnn
 from modules.bnn.modules.loss import GaussianKLLoss, nELBO
 from modules.bnn.utils import *
+from modules.bnn.evaluation import evaluate
 
 import datasets.mnist as d
 
@@ -24,7 +27,13 @@ x_dim, y_dim = 784, 10
 h1_dim, h2_dim = 128, 64
 layer_sizes = [x_dim, h1_dim, h2_dim, y_dim]
 activation = nn.GELU()
-model = make_linear_emp_bnn(layer_sizes, activation=activation, device=device)
+layer_kwargs = {'init_std': 'prior', 'sampling': 'local', 'device': device}
+conv = True  # convolutional BNN sharing one learnable prior std, as bnn_mnist.py
+if conv:
+    model = make_conv_emp_bnn((1, 28, 28), [16, 32, 32], [64, y_dim], init_prior_std=1.0, kernel_size=5,
+                              activation=activation, **layer_kwargs)
+else:
+    model = make_linear_emp_bnn(layer_sizes, 1.0, activation=activation, **layer_kwargs)
 print("BNN architecture: \n", model)
 
 # training hyperparameters
@@ -38,8 +47,19 @@ cross_entropy_loss = nn.CrossEntropyLoss(reduction='sum')
 kl_loss = GaussianKLLoss()
 nelbo = nELBO(nll_loss=cross_entropy_loss, kl_loss=kl_loss)
 
-print(f"kl before training: {kl_loss(model)}")  # should be approx. 273,465 for MNIST (109,386 params)
-logs = training_loop(model, N_epochs, opt, nelbo, train_loader, test_loader, experiment_name)
+print(f"kl before training: {kl_loss(model)}")
+model.train()
+logs = []
+for i in range(N_epochs):
+    # train step is whole training dataset (minibatched inside function), no likelihood noise
+    loss, nll, kl = train_step(model, opt, nelbo, train_loader, None, device)
+    results = evaluate(model, {'test': (test_loader, None)}, ['accuracy', 'nll', 'calibration'],
+                       K=50, task='classification', device=device)['test']
+    prior_std = to_numpy(F.softplus(model._prior_std_param))
+    logs.append([i+1, to_numpy(loss), to_numpy(nll), to_numpy(kl), prior_std, results['accuracy']])
+    print("Epoch {}, nelbo={}, nll={}, kl={}, prior_std={}, accuracy={:.2f}%".format(
+        i+1, logs[-1][1], logs[-1][2], logs[-1][3], logs[-1][4], 100. * logs[-1][5]))
+logs = np.array(logs)
 
 plot_training_loss(logs)
 write_logs_to_file(logs, experiment_name)
@@ -7,6 +7,7 @@ import torch.nn as nn
 from modules.bnn.modules.ext_emp_linear import make_linear_ext_emp_bnn
 from modules.bnn.modules.loss import GaussianKLLoss, nELBO
 from modules.bnn.utils import *
+from modules.bnn.evaluation import evaluate
 
 import datasets.mnist as d
 
@@ -29,6 +30,8 @@ x_dim, y_dim = 784, 10
 h1_dim, h2_dim = 128, 64
 layer_sizes = [x_dim, h1_dim, h2_dim, y_dim]
 activation = nn.GELU()
+# stays fully connected: the per-layer learnable priors have no convolutional counterpart and
+# the saved models of this experiment are fully connected
 model = make_linear_ext_emp_bnn(layer_sizes, activation=activation, device=device)
 print("BNN architecture: \n", model)
 
@@ -52,4 +55,7 @@ if TRAINING:
 
 else:
     model = load_model(model, experiment_name)
-    test_step(model, nelbo, test_loader, predict=predict, device=device)
+    results = evaluate(model, {'test': (test_loader, None)}, ['accuracy', 'nll', 'calibration'],
+                       K=50, task='classification', device=device)['test']
+    print('\nTest set: Accuracy: {:.2f}%, NLL: {:.4f}, ECE: {:.4f}\n'.format(
+        100. * results['accuracy'], results['nll'], results['calibration']))
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+
+def expand_grid(grid):
+    """
+    Every combination of a hyperparameter grid {name: [values]} as a list of config dicts,
+    in the order of the nested loops over the grid's values. Hyperparameters that are only
+    varied together share a tuple of names, e.g. {('prior_weight_std', 'prior_bias_std'): [(1, 1), (1, 5)]}.
+    """
+    configs = []
+    for values in itertools.product(*grid.values()):
+        config = {}
+        for name, value in zip(grid, values):
+            if isinstance(name, tuple):
+                config.update(zip(name, value))
+            else:
+                config[name] = value
+        configs.append(config)
+    return configs
+
+
+def config_key(config):
+    # canonical string identifying a config in the ledger
+    return json.dumps(config, sort_keys=True)
+
+
+def load_ledger(path):
+    """
+    Completed jobs recorded in the JSONL ledger at path, {(config_key, fold): result}.
+    A partly written last line (the run was killed while appending) is ignored.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[(config_key(entry['config']), entry['fold'])] = entry['result']
+    return done
+
+
+def _drop_partial_line(path):
+    # cut a line left unfinished by a killed run, so the next entry starts on its own line
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def _append_ledger(path, config, fold, result):
+    # one line per job, flushed to disk before the job counts as done
+    with open(path, 'a') as f:
+        f.write(json.dumps({'config': config, 'fold': fold, 'result': result}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _init_worker(path):
+    # jobs are small, so one thread per process and one process per core
+    torch.set_num_threads(1)
+    sys.path[:0] = path
+
+
+def run_cross_val(job, grid, n_splits, ledger, num_workers=None, seed=0):
+    """
+    Run job(config, fold, n_splits, seed) for every config of the hyperparameter grid and
+    every fold on a pool of num_workers processes (default: one per core). job must be a
+    module level function returning a float or a dict of floats, and must split its data
+    with the given seed (e.g. KFold(n_splits, shuffle=True, random_state=seed)) so every
+    job of a resumed sweep sees the same folds. Each result is appended to the JSONL
+    ledger as soon as its job finishes, and jobs already in the ledger are skipped, so an
+    interrupted sweep is resumed by calling run_cross_val again with the same arguments.
+    Returns [(config, mean result over the folds)] in grid order.
+    """
+    configs = expand_grid(grid) if isinstance(grid, dict) else list(grid)
+    os.makedirs(os.path.dirname(ledger) or '.', exist_ok=True)
+    _drop_partial_line(ledger)
+    done = load_ledger(ledger)
+    todo = [(config, fold) for config in configs for fold in range(n_splits)
+            if (config_key(config), fold) not in done]
+    print(f'{len(configs)*n_splits - len(todo)} of {len(configs)*n_splits} jobs in {ledger}, running {len(todo)}')
+
+    if todo:
+        num_workers = min(num_workers or os.cpu_count(), len(todo))
+        # spawn, as forked workers can not use CUDA
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(sys.path,)) as pool:
+            futures = {pool.submit(job, config, fold, n_splits, seed): (config, fold) for config, fold in todo}
+            try:
+                for future in as_completed(futures):
+                    config, fold = futures[future]
+                    result = future.result()
+                    _append_ledger(ledger, config, fold, result)
+                    done[(config_key(config), fold)] = result
+                    print(f'Completed fold {fold} of {config}: {result}')
+            except BaseException:
+                # a failed job or Ctrl-C: drop the queued jobs, the finished ones are in the ledger
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    return [(config, _fold_mean([done[(config_key(config), fold)] for fold in range(n_splits)]))
+            for config in configs]
+
+
+def _fold_mean(results):
+    if isinstance(results[0], dict):
+        return {name: sum(r[name] for r in results) / len(results) for name in results[0]}
+    return sum(results) / len(results)
@@ -0,0 +1,100 @@
+import torch
+import torch.nn.functional as F
+
+from modules.bnn.utils import predict_streaming, device
+
+
+REGRESSION_METRICS = ('mse', 'gnll', 'calibration')
+CLASSIFICATION_METRICS = ('accuracy', 'nll', 'calibration')
+# central interval levels checked by the regression calibration error
+CALIBRATION_LEVELS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def evaluate(model, datasets, metrics=('mse', 'gnll'), K=50, log_lik_var=None,
+             task='regression', sample_chunk=None, input_chunk=None, device=device):
+    """
+    Compute every metric on every dataset from a single batched Monte Carlo pass per minibatch,
+    keeping all sums on the device. datasets maps a name to (dataloader, normal_train): the
+    loader of a dataset in original units is normalised with the statistics of normal_train and
+    the predictions unnormalised before scoring, pass normal_train=None for a loader that is
+    already normalised (e.g. the training set). Returns {name: {metric: float}}, e.g.
+        evaluate(model, {'test': (test_loader, train), 'train': (train_loader, None)},
+                 ['mse', 'gnll', 'calibration'], log_lik_var=log_lik_var)
+    Regression metrics: 'mse', 'gnll' (Gaussian NLL of the predictive distribution including
+    the likelihood noise exp(log_lik_var)) and 'calibration' (mean absolute difference between
+    the coverage of the central predictive intervals and their level). Classification metrics
+    (task='classification', predictive probabilities averaged over samples): 'accuracy', 'nll'
+    and 'calibration' (expected calibration error over 10 confidence bins).
+    sample_chunk/input_chunk bound the memory of the MC pass, see predict_streaming.
+    """
+    valid = REGRESSION_METRICS if task == 'regression' else CLASSIFICATION_METRICS
+    for metric in metrics:
+        if metric not in valid:
+            raise ValueError(f"{task} metrics must be in {valid}, got '{metric}'")
+    accumulate = _regression_sums if task == 'regression' else _classification_sums
+
+    results = {}
+    with torch.no_grad():
+        for name, (dataloader, normal_train) in datasets.items():
+            sums = {}
+            for x, y in dataloader:
+                x = x.to(device).reshape((x.shape[0], -1))
+                y = y.to(device)
+                if normal_train is not None:
+                    x = (x - _as_tensor(normal_train.x_mean, x)) / _as_tensor(normal_train.x_std, x)
+                # predictive mean and variance (mean and variance of the probabilities for classification)
+                moments = predict_streaming(
+                    model, x, K, sample_chunk, input_chunk, task == 'classification', device
+                )
+                for metric, value in accumulate(*moments, y, metrics, log_lik_var, normal_train).items():
+                    sums[metric] = sums.get(metric, 0.) + value
+            count = sums.pop('count')
+            if 'calibration' in sums:
+                # signed per-level (per-bin) errors are only made absolute over the whole dataset
+                calibration = sums['calibration'].abs()
+                sums['calibration'] = calibration.mean() if task == 'regression' else calibration.sum()
+            results[name] = {metric: float(value / count) for metric, value in sums.items()}
+    return results
+
+
+def _as_tensor(stat, like):
+    return torch.as_tensor(stat, device=like.device, dtype=like.dtype)
+
+
+def _regression_sums(mean, var, y, metrics, log_lik_var, normal_train):
+    if log_lik_var is not None:
+        var = var + torch.exp(log_lik_var)
+    if normal_train is not None:
+        y_mean, y_std = _as_tensor(normal_train.y_mean, y), _as_tensor(normal_train.y_std, y)
+        mean = mean * y_std + y_mean
+        var = var * y_std**2
+    sums = {'count': y.numel()}
+    if 'mse' in metrics:
+        sums['mse'] = ((mean - y)**2).sum()
+    if 'gnll' in metrics:
+        sums['gnll'] = F.gaussian_nll_loss(mean, y, var, full=True, reduction='sum')
+    if 'calibration' in metrics:
+        # |y - mean| / std falls in the central interval of level p iff it is below Phi^-1((1+p)/2)
+        z = (y - mean).abs() / var.clamp_min(1e-16).sqrt()
+        levels = torch.tensor(CALIBRATION_LEVELS, device=y.device, dtype=y.dtype)
+        bounds = torch.special.ndtri((1 + levels) / 2)
+        coverage = (z.reshape(-1, 1) <= bounds).sum(0)
+        sums['calibration'] = coverage - levels * y.numel()
+    return sums
+
+
+def _classification_sums(probs, probs_var, y, metrics, log_lik_var, normal_train, num_bins=10):
+    confidence, label = probs.max(-1)
+    correct = (label == y).to(probs.dtype)
+    sums = {'count': y.numel()}
+    if 'accuracy' in metrics:
+        sums['accuracy'] = correct.sum()
+    if 'nll' in metrics:
+        sums['nll'] = -torch.log(probs.gather(-1, y[:, None]).clamp_min(1e-12)).sum()
+    if 'calibration' in metrics:
+        # per-bin sum of confidence - correct
+        bins = (confidence * num_bins).long().clamp_max(num_bins - 1)
+        sums['calibration'] = torch.zeros(num_bins, device=y.device, dtype=probs.dtype).index_add_(
+            0, bins, confidence - correct
+        )
+    return sums
@@ -1,12 +1,5 @@
 import torch
 
-from modules.bnn.modules.linear import BayesLinear
-from modules.bnn.modules.emp_linear import EmpBayesLinear
-from modules.bnn.modules.ext_emp_linear import ExtEmpBayesLinear
-from modules.bnn.modules.mlg_linear import MLGBayesLinear
-from modules.bnn.modules.cm_linear import CMBayesLinear
-from modules.bnn.modules.cmv_linear import CMVBayesLinear
-
 
 def _gaussian_kl(mean_q, std_q, mean_p, std_p):
     """
@@ -19,33 +12,97 @@ def _gaussian_kl(mean_q, std_q, mean_p, std_p):
     return kl.sum()
 
 
+def _lowrank_gaussian_kl(mean_q, std_q, factor_q, mean_p, std_p):
+    """
+    KL divergence between N(mean_q, diag(std_q^2) + factor_q factor_q^T) and a diagonal Gaussian.
+    mean_q/std_q have P elements and factor_q has shape (P, r); the log-determinant of the
+    posterior covariance uses the matrix determinant lemma, so the cost is O(P r^2 + r^3).
+    """
+    var_q = std_q.flatten()**2
+    var_p = (std_p**2).expand_as(std_q).flatten()
+    trace = (var_q / var_p).sum() + (factor_q**2 / var_p[:, None]).sum()
+    mahalanobis = ((mean_q - mean_p).flatten()**2 / var_p).sum()
+    # det(D + U U^T) = det(D) det(I + U^T D^-1 U)
+    capacitance = torch.eye(factor_q.shape[1], device=factor_q.device, dtype=factor_q.dtype)
+    capacitance = capacitance + factor_q.T @ (factor_q / var_q[:, None])
+    logdet_q = torch.log(var_q).sum() + 2 * torch.log(torch.linalg.cholesky(capacitance).diagonal()).sum()
+    logdet_p = torch.log(var_p).sum()
+    return 0.5 * (trace + mahalanobis - var_q.numel() + logdet_p - logdet_q)
+
+
+def _matrix_normal_kl(mean_q, row_tril_q, col_tril_q, mean_p, std_p):
+    """
+    KL divergence between the matrix normal MN(mean_q, U, V), with U = row_tril_q row_tril_q^T
+    (out x out) and V = col_tril_q col_tril_q^T (in x in), and the isotropic Gaussian N(mean_p, std_p^2 I).
+    Uses tr(V kron U) = tr(U) tr(V) and log det(V kron U) = in log det U + out log det V.
+    """
+    if std_p.numel() != 1:
+        raise ValueError('the matrix normal KL needs a single prior std shared by all weights')
+    out_features, in_features = mean_q.shape
+    num_weights = out_features * in_features
+    var_p = std_p.reshape(())**2
+    trace = row_tril_q.pow(2).sum() * col_tril_q.pow(2).sum() / var_p
+    mahalanobis = (mean_q - mean_p).pow(2).sum() / var_p
+    logdet_q = 2 * (in_features * torch.log(row_tril_q.diagonal()).sum()
+                    + out_features * torch.log(col_tril_q.diagonal()).sum())
+    return 0.5 * (trace + mahalanobis - num_weights + num_weights * torch.log(var_p) - logdet_q)
+
+
+def _relu_moments(mean, var, negative_slope=0.):
+    """
+    Mean and variance of LeakyReLU(x) (ReLU for negative_slope=0) for x ~ N(mean, var), using
+    the rectified Gaussian moments E[relu(x)] = mean Phi(a) + std phi(a) and
+    E[relu(x)^2] = (mean^2 + var) Phi(a) + mean std phi(a), with a = mean/std.
+    """
+    std = var.clamp_min(1e-16).sqrt()
+    a = mean / std
+    cdf = torch.special.ndtr(a)
+    pdf = torch.exp(-0.5 * a**2) / (2 * torch.pi)**0.5
+    second = mean**2 + var
+    relu_mean = mean * cdf + std * pdf
+    relu_second = second * cdf + mean * std * pdf
+    out_mean = negative_slope * mean + (1 - negative_slope) * relu_mean
+    out_second = relu_second + negative_slope**2 * (second - relu_second)
+    return out_mean, (out_second - out_mean**2).clamp_min(0.)
+
+
+def _kl_terms(model, kl_type):
+    """
+    Bound regulariser methods of every layer contributing to the kl_type regulariser.
+    Layers declare what they contribute through their kl_terms attribute; the model is only
+    traversed on the first call and the result is cached on the model.
+    """
+    registry = getattr(model, '_kl_registry', None)
+    if registry is None:
+        registry = {}
+        model._kl_registry = registry
+    if kl_type not in registry:
+        registry[kl_type] = [
+            getattr(m, m.kl_terms[kl_type]) for m in model.modules()
+            if kl_type in getattr(m, 'kl_terms', {})
+        ]
+    return registry[kl_type]
+
+
+def _sum_terms(model, kl_type):
+    terms = _kl_terms(model, kl_type)
+    if not terms:
+        return torch.zeros((), device=next(model.parameters()).device)
+    return torch.stack([term() for term in terms]).sum()
+
+
 def gaussian_kl_loss(model):
     """
     KL divergence between approximate posterior and prior, assuming both are diagonal Gaussian.
     This is the closed form complexity cost in Weight Uncertainty in Neural Networks.
     """
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    kl = torch.Tensor([0]).to(device)
-    kl_sum = torch.Tensor([0]).to(device)
-    for m in model.modules():
-        if (isinstance(m, (BayesLinear))
-                or isinstance(m, (EmpBayesLinear))
-                or isinstance(m, (ExtEmpBayesLinear))
-                or isinstance(m, (MLGBayesLinear))):
-            kl = _gaussian_kl(m.weight_mean, m.weight_std, m.prior_weight_mean, m.prior_weight_std)
-            kl_sum += kl
-            if m.bias:
-                kl = _gaussian_kl(m.bias_mean, m.bias_std, m.prior_bias_mean, m.prior_bias_std)
-                kl_sum += kl
-    return kl_sum
+    return _sum_terms(model, 'gaussian')
 
 
 def nelbo(model, loss_args, minibatch_ratio, nll_loss, kl_loss):
     """
     kl divided by number of minibatches
     """
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    nelbo = torch.Tensor([0]).to(device)
     nll = nll_loss(*loss_args)
     kl = kl_loss(model) * minibatch_ratio
     nelbo = nll + kl
@@ -62,17 +119,7 @@ def _cml(post_mean, post_std, alpha, prior_std):
 
 
 def cm_loss(model):
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    cml = torch.Tensor([0]).to(device)
-    cml_sum = torch.Tensor([0]).to(device)
-    for m in model.modules():
-        if (isinstance(m, (CMBayesLinear))):
-            cml = _cml(m.weight_mean, m.weight_std, m.prior_mean_hyperstd, m.prior_weight_std)
-            cml_sum += cml
-            if m.bias:
-                cml = _cml(m.bias_mean, m.bias_std, m.prior_mean_hyperstd, m.prior_bias_std)
-                cml_sum += cml
-    return cml_sum
+    return _sum_terms(model, 'cm')
 
 
 def _cmvl(post_mean, post_std, alpha, beta, delta):
@@ -83,39 +130,14 @@ def _cmvl(post_mean, post_std, alpha, beta, delta):
 
 
 def cmv_loss(model):
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    cmvl = torch.Tensor([0]).to(device)
-    cmvl_sum = torch.Tensor([0]).to(device)
-    for m in model.modules():
-        if (isinstance(m, (CMVBayesLinear))):
-            cmvl = _cmvl(m.weight_mean, m.weight_std, m.hyperprior_alpha, m.hyperprior_beta, m.hyperprior_delta)
-            cmvl_sum += cmvl
-            if m.bias:
-                cmvl = _cmvl(m.bias_mean, m.bias_std, m.hyperprior_alpha, m.hyperprior_beta, m.hyperprior_delta)
-                cmvl_sum += cmvl
-    return cmvl_sum
+    return _sum_terms(model, 'cmv')
 
 
 def prior_regularisation(model):
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    prior_dif = torch.Tensor([0]).to(device)
-    prior_dif_sum = torch.Tensor([0]).to(device)
-    for m in model.modules():
-        if (isinstance(m, (BayesLinear))
-                or isinstance(m, (EmpBayesLinear))
-                or isinstance(m, (ExtEmpBayesLinear))
-                or isinstance(m, (MLGBayesLinear))):
-            prior_dif = _gaussian_kl(m.weight_mean, m.weight_std, m.prior_weight_mean, m.prior_weight_std)
-            prior_dif_sum += kl
-            if m.bias:
-                kl = _gaussian_kl(m.bias_mean, m.bias_std, m.prior_bias_mean, m.prior_bias_std)
-                kl_sum += kl
-    return kl_sum
+    return _sum_terms(model, 'gaussian')
 
 
 def maximum_a_posteriori(model, loss_args, minibatch_ratio, nll_loss):
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    map_loss = torch.Tensor([0]).to(device)
     nll = nll_loss(*loss_args)
     prior_loss = prior_regularisation(model)
     map_loss = nll + prior_loss
@@ -127,24 +149,89 @@ def MLG_gaussian_kl(model):
     """
     KL divergence is between the epsilon posterior and prior (standard normal)
     """
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    kl = torch.Tensor([0]).to(device)
-    kl_sum = torch.Tensor([0]).to(device)
-    for m in model.modules():
-        if isinstance(m, (MLGBayesLinear)):
-            kl = _gaussian_kl(m.weight_mean, m.weight_std, torch.tensor(0), torch.tensor(1))
-            kl_sum += kl
-            if m.bias:
-                kl = _gaussian_kl(m.bias_mean, m.bias_std, torch.tensor(0), torch.tensor(1))
-                kl_sum += kl
-    return kl_sum
+    return _sum_terms(model, 'mlg')
 
 
 def MLG_approximate_scheme(model, loss_args, minibatch_ratio, nll_loss, kl_loss):
-    device = torch.device("cuda" if next(model.parameters()).is_cuda else "cpu")
-    nelbo = torch.Tensor([0]).to(device)
     nll = nll_loss(*loss_args)
     kl = kl_loss(model) * minibatch_ratio
     nelbo = nll + kl
 
-    return nelbo, nll, kl
\ No newline at end of file
+    return nelbo, nll, kl
+
+
+class _ReparamLinear(torch.autograd.Function):
+    """
+    y = x (mean + std * eps)^T + b without keeping the noise or the sampled weight alive for
+    backward: only the seed of eps is stored and the noise is regenerated in backward.
+    """
+    @staticmethod
+    def forward(ctx, input, weight_mean, weight_std, bias):
+        seed = int(torch.randint(2**62, ()).item())  # drawn from the CPU generator, no device sync
+        weight = torch.addcmul(weight_mean, weight_std, _seeded_randn(weight_std, seed))
+        ctx.seed = seed
+        ctx.has_bias = bias is not None
+        ctx.save_for_backward(input, weight_mean, weight_std)
+        return torch.nn.functional.linear(input, weight, bias)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        input, weight_mean, weight_std = ctx.saved_tensors
+        eps = _seeded_randn(weight_std, ctx.seed)
+        grad_input = grad_mean = grad_std = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_input = grad_output @ torch.addcmul(weight_mean, weight_std, eps)
+        if ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            grad_weight = grad_output.reshape(-1, grad_output.shape[-1]).T @ input.reshape(-1, input.shape[-1])
+            if ctx.needs_input_grad[1]:
+                grad_mean = grad_weight
+            if ctx.needs_input_grad[2]:
+                grad_std = grad_weight * eps
+        if ctx.has_bias and ctx.needs_input_grad[3]:
+            grad_bias = grad_output.reshape(-1, grad_output.shape[-1]).sum(0)
+        return grad_input, grad_mean, grad_std, grad_bias
+
+
+def _seeded_randn(like, seed):
+    generator = torch.Generator(device=like.device)
+    generator.manual_seed(seed)
+    return torch.randn(like.shape, generator=generator, device=like.device, dtype=like.dtype)
+
+
+class _Softplus(torch.autograd.Function):
+    """
+    softplus(param) * scale whose backward only needs param, which is held on ctx instead of
+    being saved for backward, so the graph of a std shared by several losses (forward pass,
+    KL, logging) survives the backward of each of them.
+    """
+    @staticmethod
+    def forward(ctx, param, scale):
+        ctx.param = param
+        ctx.version = param._version
+        ctx.scale = scale
+        return torch.nn.functional.softplus(param) * scale
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        if ctx.param._version != ctx.version:
+            raise RuntimeError("a parameter needed for the gradient of its softplus std was modified "
+                               "in place, recompute the std after modifying the parameter")
+        return grad_output * torch.sigmoid(ctx.param) * ctx.scale, None
+
+
+def shared_softplus(param, scale=None):
+    """
+    softplus(param) (times scale) that can be reused across backward passes until param is
+    modified in place.
+    """
+    return _Softplus.apply(param, 1.0 if scale is None else scale)
+
+
+def reparam_linear(input, weight_mean, weight_std, bias=None):
+    """
+    Linear layer with a weight sampled from N(weight_mean, weight_std^2), using about the memory
+    of a deterministic linear layer at the cost of sampling the noise twice.
+    """
+    return _ReparamLinear.apply(input, weight_mean, weight_std, bias)
@@ -1,4 +1,4 @@
 # from .linear import BayesLinear  # noqa: F401
-# # from .conv import BayesConv2d
+# from .conv import BayesConv2d, EmpBayesConv2d  # noqa: F401
 # # from .batchnorm import BayesBatchNorm2d
 # from .loss import GaussianKLLoss, nELBO  # noqa: F401
@@ -0,0 +1,308 @@
+import numpy as np
+import math
+import contextlib
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import modules.bnn.functional as BF
+from modules.bnn.noise import NOISE_MODES, standard_normal, new_sobol_seed
+
+
+# 'weight' samples one weight matrix per forward pass, 'local' samples pre-activations
+# directly (local reparameterization trick) so every example gets its own noise, 'flipout'
+# shares one weight perturbation across the minibatch with per-example random sign flips,
+# 'fused' samples like 'weight' but regenerates the noise in backward instead of storing it
+SAMPLING_MODES = ('weight', 'local', 'flipout', 'fused')
+
+
+class _BayesModule(nn.Module):
+    """Base class for the mean-field Gaussian layers.
+       Holds the approximate posterior parameters of a weight of any shape (and of a bias over
+       its first dimension), the softplus std parameterisation and the Gaussian KL. Subclasses
+       register their own prior and override _weight_moments/_bias_moments if the sampled
+       weight is not N(weight_mean, weight_std^2).
+    """
+    # regularisers this layer contributes to, mapped to the method computing its term
+    kl_terms = {'gaussian': 'kl'}
+    # attributes that are views into flat tensors owned by the parent BayesSequential
+    _flat_names = ()
+    # deterministic forward with the posterior mean weights, see set_posterior_mean
+    use_posterior_mean = False
+    # source of the reparameterization noise, one of NOISE_MODES, see set_noise
+    noise = 'iid'
+    # scrambling of this layer's Sobol points, drawn on first use
+    _sobol_seed = None
+    # whether _output_moments gives the output moments, False if the posterior correlates the outputs
+    propagates_moments = True
+
+    def __init__(self, weight_shape, bias=True, device=None, dtype=None):
+        factory_kwargs = {'device': device, 'dtype': dtype, 'requires_grad': True}
+        super(_BayesModule, self).__init__()
+        self._std_cache = {}
+
+        # approximate posterior parameters (Gaussian)
+        self.weight_mean = nn.Parameter(torch.empty(weight_shape, **factory_kwargs))
+        self._weight_std_param = nn.Parameter(torch.empty(weight_shape, **factory_kwargs))
+
+        self.bias = bias
+        if self.bias:
+            self.bias_mean = nn.Parameter(torch.empty(weight_shape[0], **factory_kwargs))
+            self._bias_std_param = nn.Parameter(torch.empty(weight_shape[0], **factory_kwargs))
+        else:
+            self.register_parameter('bias_mean', None)
+            self.register_parameter('_bias_std_param', None)
+
+    def _prior_repr(self):
+        repr = ""
+        prior_weight_std = getattr(self, 'prior_weight_std', None)
+        if torch.is_tensor(prior_weight_std):
+            weight_std = prior_weight_std.data.flatten()[0]
+            if torch.allclose(weight_std, prior_weight_std):
+                repr += f", weight prior std={weight_std.item():.2f}"
+        prior_bias_std = getattr(self, 'prior_bias_std', None)
+        if torch.is_tensor(prior_bias_std):
+            bias_std = prior_bias_std.data.flatten()[0]
+            if torch.allclose(bias_std, prior_bias_std):
+                repr += f", bias prior std={bias_std.item():.2f}"
+        return repr
+
+    def reset_parameters(self, init_std=0.05):
+        # nn.init.kaiming_uniform_(self.weight_mean, a=math.sqrt(5))
+        bound = 1. / math.sqrt(self.weight_mean.shape[1:].numel())
+        nn.init.uniform_(self.weight_mean, -bound, bound)
+        nn.init.constant_(self._weight_std_param, np.log(np.exp(init_std) - 1))
+        if self.bias:
+            nn.init.uniform_(self.bias_mean, -bound, bound)
+            nn.init.constant_(self._bias_std_param, np.log(np.exp(init_std) - 1))
+
+    def __getstate__(self):
+        # cached stds and views into a flat parameter store (see BayesSequential.flatten_parameters)
+        # are part of the autograd graph, recompute them after copying/unpickling
+        state = super(_BayesModule, self).__getstate__().copy()
+        if state['_std_cache'] is not None:
+            state['_std_cache'] = {}
+        for name in self._flat_names:
+            state.pop(name, None)
+        return state
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store the constant priors as full-size buffers, collapse them
+        # to the scalar buffers the layers now register
+        for name, buf in self._buffers.items():
+            saved = state_dict.get(prefix + name)
+            if buf is None or saved is None or buf.dim() > 0 or saved.dim() == 0:
+                continue
+            value = saved.flatten()[0]
+            if torch.all(saved == value):
+                state_dict[prefix + name] = value.clone()
+        super(_BayesModule, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _softplus(self, name, scale=None):
+        """
+        softplus of the named parameter (times scale), computed once and reused until the
+        parameter is modified in place (optimiser step, load_state_dict) or replaced, so the
+        forward pass, the KL and the logging of a training step share one std.
+        """
+        param = getattr(self, name)
+        if self._std_cache is None:
+            # caching disabled, e.g. for a model run under torch.func transforms (see StackedBNN)
+            std = F.softplus(param)
+            return std if scale is None else std * scale
+        key = (id(param), param._version)
+        cached = self._std_cache.get(name)
+        # a std computed under no_grad has no graph, recompute it for training
+        if cached is None or cached[0] != key or (torch.is_grad_enabled() and not cached[1].requires_grad
+                                                    and param.requires_grad):
+            cached = (key, BF.shared_softplus(param, scale))
+            self._std_cache[name] = cached
+        return cached[1]
+
+    # define the q distribution standard deviations with property decorator
+    @property
+    def weight_std(self):
+        return self._softplus('_weight_std_param')
+
+    @property
+    def bias_std(self):
+        return self._softplus('_bias_std_param')
+
+    # KL divergence KL[q||p] between approximate Gaussian posterior and Gaussian prior
+    def kl(self):
+        kl = BF._gaussian_kl(self.weight_mean, self.weight_std, self.prior_weight_mean, self.prior_weight_std)
+        if self.bias:
+            kl = kl + BF._gaussian_kl(self.bias_mean, self.bias_std, self.prior_bias_mean, self.prior_bias_std)
+        return kl
+
+    # mean of the Gaussian the weight (bias) is sampled from, without computing the std
+    def _mean_weight(self):
+        return self.weight_mean
+
+    def _mean_bias(self):
+        return self.bias_mean
+
+    # mean and std of the Gaussian the weight (bias) is sampled from
+    def _weight_moments(self):
+        return self.weight_mean, self.weight_std
+
+    def _bias_moments(self):
+        return self.bias_mean, self.bias_std
+
+    def _sample_bias(self):
+        if not self.bias:
+            return None
+        bias_mean, bias_std = self._bias_moments()
+        return bias_mean + bias_std * self._randn((1, *bias_std.shape), bias_std)[0]
+
+    # standard normal noise from the layer's noise source, shape[0] is the sample dimension
+    def _randn(self, shape, like):
+        if self.noise == 'sobol' and self._sobol_seed is None:
+            self._sobol_seed = new_sobol_seed()
+        return standard_normal(shape, self.noise, like.device, like.dtype, self._sobol_seed)
+
+
+class _BayesLinear(_BayesModule):
+    """Base class for the mean-field Gaussian linear layers, with the forward pass for every
+       sampling mode.
+    """
+    def __init__(self, in_features, out_features, bias=True, sampling='weight', device=None, dtype=None):
+        if sampling not in SAMPLING_MODES:
+            raise ValueError(f"sampling must be one of {SAMPLING_MODES}, got '{sampling}'")
+        super(_BayesLinear, self).__init__((out_features, in_features), bias, device, dtype)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.sampling = sampling
+
+    def extra_repr(self):
+        repr = "in_features={}, out_features={}, bias={}".format(
+            self.in_features, self.out_features, self.bias is not None
+        )
+        return repr + self._prior_repr()
+
+    # forward pass using reparam trick
+    def forward(self, input, variance=True):
+        if not variance or self.use_posterior_mean:
+            return F.linear(input, self._mean_weight(), self._mean_bias() if self.bias else None)
+        if self.sampling == 'local':
+            return self._local_reparam_forward(input)
+        if input.dim() == 3:
+            return self._batched_forward(input)
+        if self.sampling == 'flipout':
+            return self._flipout_forward(input)
+        if self.sampling == 'fused' and self.noise == 'iid':
+            # the fused kernel regenerates iid noise in backward, other noise sources sample the weight
+            weight_mean, weight_std = self._weight_moments()
+            return BF.reparam_linear(input, weight_mean, weight_std, self._sample_bias())
+        weight, bias = self._sample_weights(1)
+        return F.linear(input, weight[0], None if bias is None else bias[0, 0])
+
+    # K samples of the weight, (K, out_features, in_features), and of the bias, (K, 1, out_features)
+    def _sample_weights(self, num_samples):
+        weight_mean, weight_std = self._weight_moments()
+        weight = weight_mean + weight_std * self._randn(
+            (num_samples, self.out_features, self.in_features), weight_std
+        )
+        return weight, self._sample_biases(num_samples)
+
+    def _sample_biases(self, num_samples):
+        if not self.bias:
+            return None
+        bias_mean, bias_std = self._bias_moments()
+        return bias_mean + bias_std * self._randn((num_samples, 1, self.out_features), bias_std)
+
+    # forward pass for input of shape (K, batch_size, in_features): K weight samples are drawn
+    # as one stacked (K, out_features, in_features) tensor and applied with a batched matmul
+    def _batched_forward(self, input):
+        weight, bias = self._sample_weights(input.shape[0])
+        if bias is None:
+            return torch.bmm(input, weight.transpose(1, 2))
+        return torch.baddbmm(bias, input, weight.transpose(1, 2))
+
+    # forward pass using flipout: one weight perturbation is shared by the minibatch and
+    # decorrelated between examples with random sign flips on the inputs and outputs
+    def _flipout_forward(self, input):
+        weight_mean, weight_std = self._weight_moments()
+        out = F.linear(input, weight_mean, self._sample_bias())
+        weight_noise = weight_std * self._randn((1, *weight_std.shape), weight_std)[0]
+        sign_in = torch.empty_like(input).bernoulli_(0.5).mul_(2).sub_(1)
+        sign_out = torch.empty_like(out).bernoulli_(0.5).mul_(2).sub_(1)
+        return out + F.linear(input * sign_in, weight_noise) * sign_out
+
+    # forward pass using local reparam trick: pre-activations are sampled from their Gaussian
+    # N(x mean^T, x^2 std^2^T), so each example gets its own noise and no weight is sampled
+    def _local_reparam_forward(self, input):
+        out_mean, out_var = self._output_moments(input)
+        return out_mean + out_var.clamp_min(1e-16).sqrt() * self._randn(out_mean.shape, out_mean)
+
+    # mean and variance of the pre-activations for an input with independent elements of the
+    # given mean and variance (var=None for a deterministic input)
+    def _output_moments(self, mean, var=None):
+        weight_mean, weight_std = self._weight_moments()
+        if self.bias:
+            bias_mean, bias_std = self._bias_moments()
+            bias_var = bias_std**2
+        else:
+            bias_mean = None; bias_var = None
+        out_mean = F.linear(mean, weight_mean, bias_mean)
+        if var is None:
+            return out_mean, F.linear(mean**2, weight_std**2, bias_var)
+        out_var = F.linear(var, weight_mean**2) + F.linear(mean**2 + var, weight_std**2, bias_var)
+        return out_mean, out_var
+
+
+def set_posterior_mean(model, mode=True):
+    """
+    Switch every Bayesian layer of model to (mode=True) or back from (mode=False) the
+    deterministic forward pass using the posterior mean weights: no noise is sampled and the
+    stds are not computed.
+    """
+    for m in model.modules():
+        if isinstance(m, _BayesModule):
+            m.use_posterior_mean = mode
+    return model
+
+
+@contextlib.contextmanager
+def posterior_mean(model):
+    """
+    Context manager running model with its posterior mean weights, e.g.
+        with posterior_mean(model):
+            y_pred = model(x)
+    """
+    layers = [m for m in model.modules() if isinstance(m, _BayesModule)]
+    modes = [m.use_posterior_mean for m in layers]
+    set_posterior_mean(model)
+    try:
+        yield model
+    finally:
+        for m, mode in zip(layers, modes):
+            m.use_posterior_mean = mode
+
+
+def set_noise(model, noise='iid'):
+    """
+    Set the noise source (one of NOISE_MODES) of every Bayesian layer of model.
+    """
+    if noise not in NOISE_MODES:
+        raise ValueError(f"noise must be one of {NOISE_MODES}, got '{noise}'")
+    for m in model.modules():
+        if isinstance(m, _BayesModule):
+            m.noise = noise
+    return model
+
+
+@contextlib.contextmanager
+def noise_source(model, noise):
+    """
+    Context manager running model with the given noise source, e.g.
+        with noise_source(model, 'sobol'):
+            y_pred = model(x, num_samples=16)
+    """
+    layers = [m for m in model.modules() if isinstance(m, _BayesModule)]
+    modes = [m.noise for m in layers]
+    set_noise(model, noise)
+    try:
+        yield model
+    finally:
+        for m, mode in zip(layers, modes):
+            m.noise = mode
@@ -0,0 +1,281 @@
+import numpy as np
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
+
+from modules.bnn.modules.base import _BayesModule
+from modules.bnn.modules.linear import BayesLinear
+from modules.bnn.modules.emp_linear import EmpBayesLinear
+from modules.bnn.modules.sequential import BayesSequential
+
+
+# 'local' samples every output feature map from its Gaussian (local reparameterization trick),
+# 'weight' samples one kernel per forward pass
+CONV_SAMPLING_MODES = ('weight', 'local')
+
+
+class _BayesConv2d(_BayesModule):
+    """Base class for the mean-field Gaussian 2D convolutions.
+       With 'local' sampling the output feature maps are sampled from N(conv(x, mean), conv(x^2, std^2)),
+       so each example gets its own noise and no kernel is sampled. The input may have a leading
+       sample dimension, (K, batch_size, C, H, W), as passed by BayesSequential(num_samples=K).
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1,
+                 groups=1, bias=True, sampling='local', device=None, dtype=None):
+        if sampling not in CONV_SAMPLING_MODES:
+            raise ValueError(f"sampling must be one of {CONV_SAMPLING_MODES}, got '{sampling}'")
+        kernel_size = _pair(kernel_size)
+        super(_BayesConv2d, self).__init__(
+            (out_channels, in_channels // groups, *kernel_size), bias, device, dtype
+        )
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = _pair(stride)
+        self.padding = padding if isinstance(padding, str) else _pair(padding)
+        self.dilation = _pair(dilation)
+        self.groups = groups
+        self.sampling = sampling
+
+    def extra_repr(self):
+        repr = "{}, {}, kernel_size={}, stride={}, padding={}, bias={}".format(
+            self.in_channels, self.out_channels, self.kernel_size, self.stride, self.padding, self.bias
+        )
+        return repr + self._prior_repr()
+
+    @property
+    def fan_in(self):
+        return self.in_channels // self.groups * self.kernel_size[0] * self.kernel_size[1]
+
+    def _conv(self, input, weight, bias, groups=None):
+        return F.conv2d(input, weight, bias, self.stride, self.padding, self.dilation, groups or self.groups)
+
+    def forward(self, input, variance=True):
+        if input.dim() == 5 and (self.sampling == 'local' or not variance or self.use_posterior_mean):
+            # every example is independent given the kernel moments, fold samples into the batch
+            num_samples, batch_size = input.shape[:2]
+            output = self.forward(input.flatten(0, 1), variance)
+            return output.unflatten(0, (num_samples, batch_size))
+        if not variance or self.use_posterior_mean:
+            return self._conv(input, self._mean_weight(), self._mean_bias() if self.bias else None)
+        if self.sampling == 'local':
+            return self._local_reparam_forward(input)
+        if input.dim() == 5:
+            return self._batched_forward(input)
+        weight_mean, weight_std = self._weight_moments()
+        weight = weight_mean + weight_std * self._randn((1, *weight_std.shape), weight_std)[0]
+        return self._conv(input, weight, self._sample_bias())
+
+    # K samples of the kernel, (K, out_channels, in_channels // groups, kH, kW), and of the
+    # bias, (K, out_channels)
+    def _sample_weights(self, num_samples):
+        weight_mean, weight_std = self._weight_moments()
+        weight = weight_mean + weight_std * self._randn((num_samples, *weight_std.shape), weight_std)
+        bias = None
+        if self.bias:
+            bias_mean, bias_std = self._bias_moments()
+            bias = bias_mean + bias_std * self._randn((num_samples, self.out_channels), bias_std)
+        return weight, bias
+
+    # forward pass for input of shape (K, batch_size, C, H, W) with 'weight' sampling
+    def _batched_forward(self, input):
+        weight, bias = self._sample_weights(input.shape[0])
+        return sampled_conv2d(input, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+
+    # forward pass using local reparam trick over the output feature maps
+    def _local_reparam_forward(self, input):
+        out_mean, out_var = self._output_moments(input)
+        return out_mean + out_var.clamp_min(1e-16).sqrt() * self._randn(out_mean.shape, out_mean)
+
+    # mean and variance of the output feature maps, see _BayesLinear._output_moments
+    def _output_moments(self, mean, var=None):
+        weight_mean, weight_std = self._weight_moments()
+        if self.bias:
+            bias_mean, bias_std = self._bias_moments()
+            bias_var = bias_std**2
+        else:
+            bias_mean = None; bias_var = None
+        out_mean = self._conv(mean, weight_mean, bias_mean)
+        if var is None:
+            return out_mean, self._conv(mean**2, weight_std**2, bias_var)
+        out_var = self._conv(var, weight_mean**2, None) + self._conv(mean**2 + var, weight_std**2, bias_var)
+        return out_mean, out_var
+
+
+class BayesConv2d(_BayesConv2d):
+    """Applies a 2D convolution with kernel and bias sampled from the approximate q distribution,
+       under a fixed zero mean Gaussian prior.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1,
+                 groups=1, prior_weight_std=1.0, prior_bias_std=1.0, bias=True, init_std=0.05,
+                 sqrt_width_scaling=True, sampling='local', device=None, dtype=None):
+        super(BayesConv2d, self).__init__(
+            in_channels, out_channels, kernel_size, stride, padding, dilation, groups, bias, sampling, device, dtype
+        )
+
+        # prior parameters (Gaussian)
+        prior_mean = 0.0
+        self.sqrt_width_scaling = sqrt_width_scaling
+        self.prior_w_std = prior_weight_std
+        self.prior_b_std = prior_bias_std
+        if sqrt_width_scaling:  # prior variance scales as 1/fan_in
+            prior_weight_std /= self.fan_in ** 0.5
+        # prior parameters are registered as scalar constants and broadcast against the weights
+        self.register_buffer('prior_weight_mean', self.weight_mean.new_full((), prior_mean))
+        self.register_buffer('prior_weight_std', self._weight_std_param.new_full((), prior_weight_std))
+        if self.bias:
+            self.register_buffer('prior_bias_mean', self.bias_mean.new_full((), prior_mean))
+            self.register_buffer('prior_bias_std', self._bias_std_param.new_full((), prior_bias_std))
+        else:
+            self.register_buffer('prior_bias_mean', None)
+            self.register_buffer('prior_bias_std', None)
+
+        self.reset_parameters(init_std)
+
+    def reset_parameters(self, init_std=0.05):
+        if init_std == 'prior':
+            w_mean_std = 0.0
+            b_mean_std = 0.0
+            w_init_std = self.prior_w_std
+            b_init_std = self.prior_b_std
+            if self.sqrt_width_scaling:
+                w_init_std /= self.fan_in
+        else:
+            w_mean_std = 1.0 / self.fan_in
+            b_mean_std = 1.0 / self.fan_in
+            w_init_std = init_std
+            b_init_std = init_std
+        nn.init.normal_(self.weight_mean, 0.0, w_mean_std)
+        nn.init.constant_(self._weight_std_param, np.log(np.exp(w_init_std) - 1))
+        if self.bias:
+            nn.init.normal_(self.bias_mean, 0.0, b_mean_std)
+            nn.init.constant_(self._bias_std_param, np.log(np.exp(b_init_std) - 1))
+
+
+class EmpBayesConv2d(_BayesConv2d):
+    """Learnable single prior std shared by all weights and biases (see EmpBayesLinear).
+       Prior mean is zero for all weights and biases.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, _prior_std_param, stride=1, padding=0,
+                 dilation=1, groups=1, bias=True, init_std=0.05, sqrt_width_scaling=True,
+                 sampling='local', device=None, dtype=None):
+        super(EmpBayesConv2d, self).__init__(
+            in_channels, out_channels, kernel_size, stride, padding, dilation, groups, bias, sampling, device, dtype
+        )
+
+        # prior parameters (Gaussian)
+        prior_mean = 0.0
+        self.sqrt_width_scaling = sqrt_width_scaling
+        self.register_buffer('prior_weight_mean', self.weight_mean.new_full((), prior_mean))
+        self._prior_weight_std_param = _prior_std_param
+        if self.bias:
+            self.register_buffer('prior_bias_mean', self.bias_mean.new_full((), prior_mean))
+            self._prior_bias_std_param = _prior_std_param
+        else:
+            self.register_buffer('prior_bias_mean', None)
+            self.register_buffer('prior_bias_std', None)
+
+        self.reset_parameters(init_std)
+
+    def reset_parameters(self, init_std=0.05):
+        if init_std == 'prior':
+            w_mean_std = 0.0
+            b_mean_std = 0.0
+            nn.init.constant_(self._weight_std_param, self._prior_weight_std_param.detach())
+            if self.bias:
+                nn.init.constant_(self._bias_std_param, self._prior_bias_std_param.detach())
+        else:
+            w_mean_std = 1.0 / self.fan_in
+            b_mean_std = 1.0 / self.fan_in
+            nn.init.constant_(self._weight_std_param, np.log(np.exp(init_std) - 1))
+            if self.bias:
+                nn.init.constant_(self._bias_std_param, np.log(np.exp(init_std) - 1))
+        nn.init.normal_(self.weight_mean, 0.0, w_mean_std)
+        if self.bias:
+            nn.init.normal_(self.bias_mean, 0.0, b_mean_std)
+
+    @property
+    def weight_std(self):
+        return self._softplus('_weight_std_param', scale=self.fan_in**-0.5)
+
+    @property
+    def prior_weight_std(self):
+        if self.sqrt_width_scaling:
+            return self._softplus('_prior_weight_std_param', scale=self.fan_in**-0.5)
+        return self._softplus('_prior_weight_std_param')
+
+    @property
+    def prior_bias_std(self):
+        return self._softplus('_prior_bias_std_param')
+
+
+def sampled_conv2d(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
+    """
+    Convolution of input (K, batch_size, C, H, W) with K kernels (K, out_channels, C // groups, kH, kW)
+    and biases (K, out_channels), the k-th kernel applied to the k-th slice of the input. The K
+    convolutions run as one grouped convolution over the stacked samples.
+    """
+    num_samples, out_channels = weight.shape[:2]
+    output = F.conv2d(
+        input.transpose(0, 1).flatten(1, 2), weight.flatten(0, 1), None if bias is None else bias.flatten(),
+        stride, padding, dilation, num_samples * groups
+    )
+    return output.unflatten(1, (num_samples, out_channels)).transpose(0, 1)
+
+
+def _conv_output_size(size, kernel_size):
+    # stride 2 convolution with 'same'-style padding, halves the image size
+    return (size + 2 * (kernel_size // 2) - kernel_size) // 2 + 1
+
+
+def _add_conv_layers(net, name, conv_layer, image_shape, conv_channels, layer_sizes, kernel_size, nonlinearity):
+    in_channels, height, width = image_shape
+    # accepts flattened images, (batch_size, C*H*W), as the MNIST loops pass them
+    net.add_module('Unflatten', nn.Unflatten(-1, tuple(image_shape)))
+    for i, out_channels in enumerate(conv_channels):
+        net.add_module(f'{name}{i}', conv_layer(in_channels, out_channels, kernel_size, 2, kernel_size // 2))
+        net.add_module(f'ConvNonlinearity{i}', nonlinearity)
+        in_channels = out_channels
+        height, width = _conv_output_size(height, kernel_size), _conv_output_size(width, kernel_size)
+    net.add_module('Flatten', nn.Flatten(start_dim=-3))
+    return [in_channels * height * width] + list(layer_sizes)
+
+
+# construct a convolutional BNN: stride 2 Bayesian convolutions followed by Bayesian linear layers
+def make_conv_bnn(image_shape, conv_channels, layer_sizes, kernel_size=5, activation='ReLU', **layer_kwargs):
+    nonlinearity = getattr(nn, activation)() if isinstance(activation, str) else activation
+    net = BayesSequential()
+    layer_sizes = _add_conv_layers(
+        net, 'BayesConv2d', lambda *args: BayesConv2d(*args, **layer_kwargs),
+        image_shape, conv_channels, layer_sizes, kernel_size, nonlinearity
+    )
+    for i, (dim_in, dim_out) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])):
+        net.add_module(f'BayesLinear{i}', BayesLinear(dim_in, dim_out, **layer_kwargs))
+        if i < len(layer_sizes) - 2:
+            net.add_module(f'Nonlinearity{i}', nonlinearity)
+    return net
+
+
+# construct a convolutional BNN with learnable prior (std) shared by all layers
+def make_conv_emp_bnn(image_shape, conv_channels, layer_sizes, init_prior_std, kernel_size=5,
+                      activation='ReLU', **layer_kwargs):
+    nonlinearity = getattr(nn, activation)() if isinstance(activation, str) else activation
+    net = BayesSequential()
+    net.register_parameter(
+        name='_prior_std_param',
+        param=nn.Parameter(torch.tensor(
+            np.log(np.exp(init_prior_std) - 1),
+            device=layer_kwargs.get('device')
+        ))
+    )
+    layer_sizes = _add_conv_layers(
+        net, 'EmpBayesConv2d', lambda *args: EmpBayesConv2d(*args[:3], net._prior_std_param, *args[3:], **layer_kwargs),
+        image_shape, conv_channels, layer_sizes, kernel_size, nonlinearity
+    )
+    for i, (dim_in, dim_out) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])):
+        net.add_module(f'EmpBayesLinear{i}', EmpBayesLinear(dim_in, dim_out, net._prior_std_param, **layer_kwargs))
+        if i < len(layer_sizes) - 2:
+            net.add_module(f'Nonlinearity{i}', nonlinearity)
+    return net
@@ -0,0 +1,77 @@
+import torch
+import torch.nn as nn
+
+from modules.bnn.modules.base import _BayesLinear
+from modules.bnn.modules.conv import _BayesConv2d, sampled_conv2d
+
+
+class SampledEnsemble(nn.Module):
+    """K weight samples of a trained Bayesian model, frozen into stacked tensors.
+       The weights of every Bayesian linear (convolutional) layer are drawn once, stored as
+       (K, out_features, in_features) ((K, out_channels, in_channels, kH, kW)) buffers and applied
+       with a batched einsum (grouped convolution), so repeated predictions, metrics and plots
+       all see the same K functions. The buffers keep the model's dtype unless a compact one
+       is asked for (e.g. dtype=torch.float16, which changes the metrics slightly). The other
+       modules of the model (nonlinearities) are reused as they are, Bayesian layers nested in
+       nn.Sequential containers are frozen too. The output has shape (K, batch_size, out_features).
+    """
+    def __init__(self, model, num_samples=50, dtype=None):
+        super(SampledEnsemble, self).__init__()
+        self.num_samples = num_samples
+        if dtype is None:
+            dtype = next(model.parameters()).dtype
+        self._steps = []
+        # (stride, padding, dilation, groups) of the frozen convolutions
+        self._conv_args = {}
+        with torch.no_grad():
+            self._freeze(model, '', num_samples, dtype)
+
+    def _freeze(self, container, prefix, num_samples, dtype):
+        # not named_children(), which skips repeats of a shared nonlinearity module
+        for name, module in container._modules.items():
+            name = prefix + name
+            if isinstance(module, (_BayesLinear, _BayesConv2d)):
+                weight, bias = module._sample_weights(num_samples)
+                self.register_buffer(f'{name}_weight', weight.to(dtype))
+                self.register_buffer(f'{name}_bias', None if bias is None else bias.to(dtype))
+                if isinstance(module, _BayesConv2d):
+                    self._conv_args[name] = (module.stride, module.padding, module.dilation, module.groups)
+                self._steps.append((name, True))
+            elif isinstance(module, nn.Sequential):
+                self._freeze(module, name + '_', num_samples, dtype)
+            elif any(hasattr(m, 'kl_terms') for m in module.modules()):
+                raise TypeError(f'{type(module).__name__} layers cannot be frozen into a SampledEnsemble')
+            else:
+                self.add_module(name, module)
+                self._steps.append((name, False))
+
+    def forward(self, input, num_samples=None, sample_index=None):
+        """
+        Apply all K stored samples, num_samples of them picked at random, or the stored samples
+        selected by sample_index (e.g. one chunk of them).
+        """
+        weight_index = sample_index
+        if weight_index is None and num_samples is not None and num_samples != self.num_samples:
+            if num_samples > self.num_samples:
+                raise ValueError(f'the ensemble holds {self.num_samples} samples, got num_samples={num_samples}')
+            weight_index = torch.randperm(self.num_samples)[:num_samples]
+        if weight_index is not None:
+            num_samples = len(weight_index)
+        x = input.expand(num_samples or self.num_samples, *input.shape)
+        for name, is_bayes in self._steps:
+            if not is_bayes:
+                x = getattr(self, name)(x)
+                continue
+            weight = getattr(self, f'{name}_weight')
+            bias = getattr(self, f'{name}_bias')
+            if weight_index is not None:
+                weight = weight[weight_index.to(weight.device)]
+                bias = None if bias is None else bias[weight_index.to(bias.device)]
+            bias = None if bias is None else bias.to(x.dtype)
+            if name in self._conv_args:
+                x = sampled_conv2d(x, weight.to(x.dtype), bias, *self._conv_args[name])
+                continue
+            x = torch.einsum('kbi,koi->kbo', x, weight.to(x.dtype))
+            if bias is not None:
+                x = x + bias
+        return x
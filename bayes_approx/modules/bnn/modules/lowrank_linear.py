@@ -0,0 +1,68 @@
+import torch
+import torch.nn as nn
+
+import modules.bnn.functional as BF
+from modules.bnn.modules.linear import BayesLinear
+from modules.bnn.modules.sequential import BayesSequential
+
+
+class LowRankBayesLinear(BayesLinear):
+    """Linear layer with a low rank plus diagonal Gaussian posterior over the weight,
+       N(weight_mean, diag(weight_std^2) + U U^T) with U of shape (out_features*in_features, rank),
+       and the same fixed Gaussian prior as BayesLinear. The bias stays mean-field.
+       Sampling and the KL cost O(out_features*in_features*rank); only 'weight' sampling is supported.
+    """
+    propagates_moments = False
+
+    def __init__(self, in_features, out_features, rank=2, prior_weight_std=1.0, prior_bias_std=1.0,
+                 bias=True, init_std=0.05, sqrt_width_scaling=True, sampling='weight',
+                 device=None, dtype=None):
+        if sampling != 'weight':
+            raise ValueError(f"LowRankBayesLinear only supports 'weight' sampling, got '{sampling}'")
+        self.rank = rank
+        super(LowRankBayesLinear, self).__init__(
+            in_features, out_features, prior_weight_std, prior_bias_std, bias, init_std,
+            sqrt_width_scaling, sampling, device, dtype
+        )
+
+    def extra_repr(self):
+        return super(LowRankBayesLinear, self).extra_repr() + f", rank={self.rank}"
+
+    def reset_parameters(self, init_std=0.05):
+        super(LowRankBayesLinear, self).reset_parameters(init_std)
+        if 'weight_factor' not in self._parameters:
+            self.weight_factor = nn.Parameter(self.weight_mean.new_empty(
+                (self.out_features, self.in_features, self.rank)
+            ))
+        # small random factor: the correlations are learnt starting from the mean-field posterior
+        nn.init.normal_(self.weight_factor, 0.0, 1e-3)
+
+    def kl(self):
+        kl = BF._lowrank_gaussian_kl(
+            self.weight_mean, self.weight_std, self.weight_factor.flatten(0, 1),
+            self.prior_weight_mean, self.prior_weight_std
+        )
+        if self.bias:
+            kl = kl + BF._gaussian_kl(self.bias_mean, self.bias_std, self.prior_bias_mean, self.prior_bias_std)
+        return kl
+
+    def _output_moments(self, mean, var=None):
+        raise TypeError('the low rank posterior correlates the outputs, moments are not propagated')
+
+    def _sample_weights(self, num_samples):
+        weight, bias = super(LowRankBayesLinear, self)._sample_weights(num_samples)
+        factor_noise = self._randn((num_samples, self.rank), self.weight_factor)
+        return weight + torch.einsum('oir,kr->koi', self.weight_factor, factor_noise), bias
+
+
+# construct a BNN with low rank plus diagonal posteriors
+def make_linear_lowrank_bnn(layer_sizes, rank=2, activation='LeakyReLU', flat_params=False, **layer_kwargs):
+    nonlinearity = getattr(nn, activation)() if isinstance(activation, str) else activation
+    net = BayesSequential()
+    for i, (dim_in, dim_out) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])):
+        net.add_module(f'LowRankBayesLinear{i}', LowRankBayesLinear(dim_in, dim_out, rank, **layer_kwargs))
+        if i < len(layer_sizes) - 2:
+            net.add_module(f'Nonlinearity{i}', nonlinearity)
+    if flat_params:
+        net.flatten_parameters()
+    return net
@@ -4,93 +4,67 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import modules.bnn.functional as BF
+from modules.bnn.modules.base import _BayesLinear
+from modules.bnn.modules.sequential import BayesSequential
 
-class MLGBayesLinear(nn.Module):
+
+class MLGBayesLinear(_BayesLinear):
     """Applies a linear transformation to the incoming data: y = xW^T + b, where
        the weight W and bias b are sampled from the approximate q distribSution.
     """
-    def __init__(self, in_features, out_features, prior_weight_std=1.0, prior_bias_std=1.0,
-                 bias=True, init_std=0.05, sqrt_width_scaling=True, device=None, dtype=None):
-        factory_kwargs = {'device': device, 'dtype': dtype, 'requires_grad': True}
-        super(MLGBayesLinear, self).__init__()
-        self.in_features = in_features
-        self.out_features = out_features
-
-        # approximate posterior parameters (Gaussian)
-        self.weight_mean = nn.Parameter(torch.empty((out_features, in_features), **factory_kwargs))
-        self._weight_std_param = nn.Parameter(torch.empty((out_features, in_features), **factory_kwargs))
+    kl_terms = {'gaussian': 'kl', 'mlg': 'eps_kl'}
 
-        self.bias = bias
-        if self.bias:
-            self.bias_mean = nn.Parameter(torch.empty(out_features, **factory_kwargs))
-            self._bias_std_param = nn.Parameter(torch.empty(out_features, **factory_kwargs))
-        else:
-            self.register_parameter('bias_mean', None)
-            self.register_parameter('_bias_std_param', None)
+    def __init__(self, in_features, out_features, prior_weight_std=1.0, prior_bias_std=1.0,
+                 bias=True, init_std=0.05, sqrt_width_scaling=True, sampling='weight',
+                 device=None, dtype=None):
+        super(MLGBayesLinear, self).__init__(in_features, out_features, bias, sampling, device, dtype)
         self.reset_parameters(init_std)
 
         # prior parameters (Gaussian)
         prior_mean = 0.0
         if sqrt_width_scaling:  # prior variance scales as 1/in_features
             prior_weight_std /= self.in_features**0.5
-        # prior parameters are registered as constants
-        self.register_buffer('prior_weight_mean', prior_mean * torch.ones(out_features, in_features))
-        self.register_buffer('prior_weight_std', prior_weight_std * torch.ones(out_features, in_features))
+        # prior parameters are registered as scalar constants and broadcast against the weights
+        self.register_buffer('prior_weight_mean', self.weight_mean.new_full((), prior_mean))
+        self.register_buffer('prior_weight_std', self._weight_std_param.new_full((), prior_weight_std))
         if self.bias:
-            self.register_buffer('prior_bias_mean', prior_mean * torch.ones(out_features))
-            self.register_buffer('prior_bias_std', prior_bias_std * torch.ones(out_features))
+            self.register_buffer('prior_bias_mean', self.bias_mean.new_full((), prior_mean))
+            self.register_buffer('prior_bias_std', self._bias_std_param.new_full((), prior_bias_std))
         else:
             self.register_buffer('prior_bias_mean', None)
             self.register_buffer('prior_bias_std', None)
 
-    def extra_repr(self):
-        repr = "in_features={}, out_features={}, bias={}".format(
-            self.in_features, self.out_features, self.bias is not None
-        )
-        weight_std = self.prior_weight_std.data.flatten()[0]
-        if torch.allclose(weight_std, self.prior_weight_std):
-            repr += f", weight prior std={weight_std.item():.2f}"
-        bias_std = self.prior_bias_std.flatten()[0]
-        if torch.allclose(bias_std, self.prior_bias_std):
-            repr += f", bias prior std={bias_std.item():.2f}"
-        return repr
-
-    def reset_parameters(self, init_std=0.05):
-        # nn.init.kaiming_uniform_(self.weight_mean, a=math.sqrt(5))
-        bound = 1. / math.sqrt(self.in_features)
-        nn.init.uniform_(self.weight_mean, -bound, bound)
-        nn.init.constant_(self._weight_std_param, np.log(np.exp(init_std) - 1))
+    # KL divergence between the epsilon posterior and its standard normal prior
+    def eps_kl(self):
+        zero, one = self.weight_mean.new_zeros(()), self.weight_mean.new_ones(())
+        kl = BF._gaussian_kl(self.weight_mean, self.weight_std, zero, one)
         if self.bias:
-            nn.init.uniform_(self.bias_mean, -bound, bound)
-            nn.init.constant_(self._bias_std_param, np.log(np.exp(init_std) - 1))
+            kl = kl + BF._gaussian_kl(self.bias_mean, self.bias_std, zero, one)
+        return kl
 
-    # define the q distribution standard deviations with property decorator
-    @property
-    def weight_std(self):
-        return torch.log(1 + torch.exp(self._weight_std_param))
+    # the sampled weight is prior_mean + prior_std * (mean + std * eps)
+    def _mean_weight(self):
+        return self.prior_weight_mean + self.prior_weight_std * self.weight_mean
 
-    @property
-    def bias_std(self):
-        return torch.log(1 + torch.exp(self._bias_std_param))
+    def _mean_bias(self):
+        return self.prior_bias_mean + self.prior_bias_std * self.bias_mean
 
-    # forward pass using reparam trick
-    def forward(self, input):
-        weight_eps = self.weight_mean + self.weight_std * torch.randn_like(self.weight_std)
-        weight = self.prior_weight_mean + self.prior_weight_std * weight_eps
-        if self.bias:
-            bias_eps = self.bias_mean + self.bias_std * torch.randn_like(self.bias_std)
-            bias = self.prior_bias_mean + self.prior_bias_std * bias_eps
-        else:
-            bias_eps = None; bias = None
-        return F.linear(input, weight, bias)
+    def _weight_moments(self):
+        return self._mean_weight(), self.prior_weight_std * self.weight_std
+
+    def _bias_moments(self):
+        return self._mean_bias(), self.prior_bias_std * self.bias_std
 
 
 # construct a BNN
-def make_mlg_linear_bnn(layer_sizes, activation='LeakyReLU', **layer_kwargs):
+def make_mlg_linear_bnn(layer_sizes, activation='LeakyReLU', flat_params=False, **layer_kwargs):
     nonlinearity = getattr(nn, activation)() if isinstance(activation, str) else activation
-    net = nn.Sequential()
+    net = BayesSequential()
     for i, (dim_in, dim_out) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])):
         net.add_module(f'MLGBayesLinear{i}', MLGBayesLinear(dim_in, dim_out, **layer_kwargs))
         if i < len(layer_sizes) - 2:
             net.add_module(f'Nonlinearity{i}', nonlinearity)
+    if flat_params:
+        net.flatten_parameters()
     return net
@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import modules.bnn.functional as BF
+from modules.bnn.modules.linear import BayesLinear
+from modules.bnn.modules.sequential import BayesSequential
+
+
+class MatrixNormalBayesLinear(BayesLinear):
+    """Linear layer with a matrix normal posterior over the weight, MN(weight_mean, U, V), i.e.
+       vec(W) ~ N(vec(weight_mean), V kron U), with U (out x out) and V (in x in) parameterised by
+       their Cholesky factors. The prior is the same as BayesLinear's (with a single prior std)
+       and the bias stays mean-field. Memory is O(out^2 + in^2) and a sample costs two matmuls;
+       only 'weight' sampling is supported.
+    """
+    propagates_moments = False
+
+    def __init__(self, in_features, out_features, prior_weight_std=1.0, prior_bias_std=1.0,
+                 bias=True, init_std=0.05, sqrt_width_scaling=True, sampling='weight',
+                 device=None, dtype=None):
+        if sampling != 'weight':
+            raise ValueError(f"MatrixNormalBayesLinear only supports 'weight' sampling, got '{sampling}'")
+        super(MatrixNormalBayesLinear, self).__init__(
+            in_features, out_features, prior_weight_std, prior_bias_std, bias, init_std,
+            sqrt_width_scaling, sampling, device, dtype
+        )
+
+    def reset_parameters(self, init_std=0.05):
+        super(MatrixNormalBayesLinear, self).reset_parameters(init_std)
+        # the Cholesky factors replace the per-weight std parameters
+        if self._parameters.get('_weight_std_param') is not None:
+            self.register_parameter('_weight_std_param', None)
+            self._row_scale_tril_param = nn.Parameter(self.weight_mean.new_empty((self.out_features,) * 2))
+            self._col_scale_tril_param = nn.Parameter(self.weight_mean.new_empty((self.in_features,) * 2))
+        if init_std == 'prior':
+            init_std = self.prior_weight_std.item()
+        # U = V = init_std I: independent weights with std init_std
+        for param in (self._row_scale_tril_param, self._col_scale_tril_param):
+            nn.init.zeros_(param)
+            with torch.no_grad():
+                param.diagonal().fill_(np.log(np.exp(init_std**0.5) - 1))
+
+    # lower triangular factors with positive (softplus) diagonals
+    @property
+    def row_scale_tril(self):
+        param = self._row_scale_tril_param
+        return param.tril(-1) + torch.diag_embed(F.softplus(param.diagonal()))
+
+    @property
+    def col_scale_tril(self):
+        param = self._col_scale_tril_param
+        return param.tril(-1) + torch.diag_embed(F.softplus(param.diagonal()))
+
+    # marginal std of every weight, sqrt(U_ii V_jj)
+    @property
+    def weight_std(self):
+        row_var = self.row_scale_tril.pow(2).sum(1)
+        col_var = self.col_scale_tril.pow(2).sum(1)
+        return torch.sqrt(row_var[:, None] * col_var[None, :])
+
+    def kl(self):
+        kl = BF._matrix_normal_kl(
+            self.weight_mean, self.row_scale_tril, self.col_scale_tril,
+            self.prior_weight_mean, self.prior_weight_std
+        )
+        if self.bias:
+            kl = kl + BF._gaussian_kl(self.bias_mean, self.bias_std, self.prior_bias_mean, self.prior_bias_std)
+        return kl
+
+    def _output_moments(self, mean, var=None):
+        raise TypeError('the matrix normal posterior correlates the outputs, moments are not propagated')
+
+    # W = weight_mean + A E B^T, with A, B the Cholesky factors of U, V and E standard normal
+    def _sample_weights(self, num_samples):
+        noise = self._randn((num_samples, self.out_features, self.in_features), self.weight_mean)
+        weight = self.weight_mean + self.row_scale_tril @ noise @ self.col_scale_tril.T
+        return weight, self._sample_biases(num_samples)
+
+
+# construct a BNN with matrix normal posteriors
+def make_linear_mn_bnn(layer_sizes, activation='LeakyReLU', flat_params=False, **layer_kwargs):
+    nonlinearity = getattr(nn, activation)() if isinstance(activation, str) else activation
+    net = BayesSequential()
+    for i, (dim_in, dim_out) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])):
+        net.add_module(f'MatrixNormalBayesLinear{i}', MatrixNormalBayesLinear(dim_in, dim_out, **layer_kwargs))
+        if i < len(layer_sizes) - 2:
+            net.add_module(f'Nonlinearity{i}', nonlinearity)
+    if flat_params:
+        net.flatten_parameters()
+    return net
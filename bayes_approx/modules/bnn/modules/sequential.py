@@ -0,0 +1,104 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from modules.bnn.modules.base import _BayesModule
+
+
+def _flat_kl_compatible(layer):
+    # the Gaussian KL of the layer can be computed from the flat tensors only if it is the
+    # plain KL of softplus(std param) against scalar prior buffers
+    cls = type(layer)
+    return (layer.kl_terms.get('gaussian') == 'kl' and cls.kl is _BayesModule.kl
+            and cls.weight_std is _BayesModule.weight_std and cls.bias_std is _BayesModule.bias_std
+            and all(name in layer._buffers for name in ('prior_weight_mean', 'prior_weight_std'))
+            and all(layer._buffers.get(name) is None or layer._buffers[name].dim() == 0
+                    for name in ('prior_weight_mean', 'prior_weight_std', 'prior_bias_mean', 'prior_bias_std')))
+
+
+class BayesSequential(nn.Sequential):
+    """Sequential container for Bayesian layers.
+       Calling the model with num_samples=K adds a leading sample dimension to the input, so
+       each Bayesian layer draws K weight samples at once and the K forward passes run as
+       batched matmuls. The output has shape (K, batch_size, out_features).
+    """
+    # (flat tensor name, layer, attribute name, offset, shape) of every flattened tensor
+    _flat_views = ()
+
+    def forward(self, input, num_samples=None):
+        if num_samples is not None:
+            input = input.expand(num_samples, *input.shape)
+        return super(BayesSequential, self).forward(input)
+
+    def flatten_parameters(self):
+        """
+        Move the posterior means and std parameters of all Bayesian layers into one flat
+        parameter each, with the layer tensors becoming views into them, so the optimiser
+        updates a single tensor per group. If every layer has a plain Gaussian prior with scalar
+        buffers the Gaussian KL becomes one fused elementwise + segment sum over the flat tensors,
+        the priors staying scalars in their layers and applied per segment.
+        The state dict then holds the flat tensors instead of the per-layer ones.
+        """
+        layers = [m for m in self.modules() if isinstance(m, _BayesModule)]
+        if self._flat_views or not layers:
+            return self
+        self._flat_views = []
+        fuse_kl = all(_flat_kl_compatible(m) for m in layers)
+        self._register_flat('_flat_mean', layers, ('weight_mean', 'bias_mean'))
+        self._register_flat('_flat_std_param', layers, ('_weight_std_param', '_bias_std_param'))
+        self._bind_flat_views()
+        if fuse_kl:
+            # the prior of every segment of the flat tensors, (layer, prior mean name, prior std name)
+            priors = {'weight_mean': ('prior_weight_mean', 'prior_weight_std'),
+                      'bias_mean': ('prior_bias_mean', 'prior_bias_std')}
+            segments = [(m, *priors[name], shape.numel()) for flat_name, m, name, _, shape in self._flat_views
+                        if flat_name == '_flat_mean']
+            self._flat_priors = [segment[:3] for segment in segments]
+            self.register_buffer('_flat_lengths', torch.tensor([segment[3] for segment in segments],
+                                                               device=self._flat_mean.device), persistent=False)
+        # the flat KL replaces the per-layer Gaussian terms in the regulariser registry
+        self._kl_registry = {'gaussian': [self._flat_kl]} if fuse_kl else {}
+        return self
+
+    def _register_flat(self, flat_name, layers, names):
+        entries = [(m, name) for m in layers for name in names if getattr(m, name) is not None]
+        tensors = [getattr(m, name) for m, name in entries]
+        flat = torch.cat([t.detach().reshape(-1) for t in tensors])
+        self.register_parameter(flat_name, nn.Parameter(flat))
+        offset = 0
+        for (m, name), t in zip(entries, tensors):
+            del m._parameters[name]
+            m._flat_names += (name,)
+            self._flat_views.append((flat_name, m, name, offset, t.shape))
+            offset += t.numel()
+
+    def _bind_flat_views(self):
+        # views are recreated whenever the flat tensors are replaced (.to(), .double(), ...)
+        with torch.enable_grad():
+            for flat_name, m, name, offset, shape in self._flat_views:
+                flat = getattr(self, flat_name)
+                setattr(m, name, flat[offset:offset + shape.numel()].view(shape))
+
+    def __setstate__(self, state):
+        super(BayesSequential, self).__setstate__(state)
+        if self._flat_views:
+            self._bind_flat_views()
+
+    def _apply(self, fn, *args, **kwargs):
+        super(BayesSequential, self)._apply(fn, *args, **kwargs)
+        if self._flat_views:
+            self._bind_flat_views()
+        return self
+
+    def _flat_kl(self):
+        # sum over a segment with scalar prior N(m_p, s_p^2) of the elementwise Gaussian KL is
+        # n (log s_p - 1/2) - sum log s_q + (sum (s_q^2 + m_q^2) - 2 m_p sum m_q + n m_p^2) / (2 s_p^2)
+        std_q = F.softplus(self._flat_std_param)
+        mean_q = self._flat_mean
+        sums = torch.segment_reduce(torch.stack([std_q**2 + mean_q**2, mean_q], 1), 'sum',
+                                    lengths=self._flat_lengths, axis=0)
+        mean_p = torch.stack([getattr(m, name) for m, name, _ in self._flat_priors])
+        std_p = torch.stack([getattr(m, name) for m, _, name in self._flat_priors])
+        n = self._flat_lengths.to(std_q.dtype)
+        kl = n * (torch.log(std_p) - 0.5) + (sums[:, 0] - 2*mean_p*sums[:, 1] + n*mean_p**2) / (2*std_p**2)
+        return kl.sum() - torch.log(std_q).sum()
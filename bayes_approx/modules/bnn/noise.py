@@ -0,0 +1,54 @@
+import functools
+import torch
+from torch.quasirandom import SobolEngine
+
+
+# 'iid' draws independent standard normals (plain Monte Carlo), 'antithetic' pairs every draw
+# eps with -eps along the sample dimension, 'sobol' maps a randomly shifted scrambled Sobol
+# point set through the inverse normal CDF (randomised quasi-Monte Carlo)
+NOISE_MODES = ('iid', 'antithetic', 'sobol')
+
+def standard_normal(shape, noise='iid', device=None, dtype=None, seed=None):
+    """
+    Standard normal noise of the given shape, with shape[0] the sample dimension:
+    antithetic pairs and Sobol points are spread over it, so variance reduction only applies
+    when several samples are drawn at once (e.g. model(x, num_samples=K)). seed selects the
+    Sobol scrambling, give every layer its own so their noise is independent; by default a
+    new one is drawn from the torch generator.
+    """
+    if noise == 'iid':
+        return torch.randn(shape, device=device, dtype=dtype)
+    num_samples = shape[0]
+    if noise == 'antithetic':
+        half = torch.randn(((num_samples + 1) // 2, *shape[1:]), device=device, dtype=dtype)
+        return torch.cat([half, -half])[:num_samples]
+    if noise == 'sobol':
+        if seed is None:
+            seed = new_sobol_seed()
+        dim = torch.Size(shape[1:]).numel()
+        return _sobol_normal(num_samples, dim, seed, device, dtype).reshape(shape)
+    raise ValueError(f"noise must be one of {NOISE_MODES}, got '{noise}'")
+
+
+def new_sobol_seed():
+    # from the torch generator, so torch.manual_seed makes the scrambling reproducible
+    return int(torch.randint(2**31 - 1, ()))
+
+
+@functools.lru_cache(maxsize=64)
+def _scrambled_sobol(num_points, dim, seed):
+    # scrambling is expensive for wide layers, so each point set is scrambled once and
+    # re-randomised in _sobol_normal; dimensions above MAXDIM are split over independent engines
+    chunks = []
+    for start in range(0, dim, SobolEngine.MAXDIM):
+        engine = SobolEngine(min(SobolEngine.MAXDIM, dim - start), scramble=True, seed=seed + start)
+        chunks.append(engine.draw(num_points, dtype=torch.float64))
+    return torch.cat(chunks, dim=1)
+
+
+def _sobol_normal(num_points, dim, seed, device, dtype):
+    points = _scrambled_sobol(num_points, dim, seed).to(device)
+    # uniform random shift modulo 1 keeps the low discrepancy and makes every draw unbiased
+    shift = torch.rand(dim, device=device, dtype=torch.float64)
+    uniform = torch.frac(points + shift).clamp_(1e-10, 1 - 1e-10)
+    return torch.special.ndtri(uniform).to(dtype or torch.get_default_dtype())
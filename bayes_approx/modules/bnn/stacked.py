@@ -0,0 +1,146 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from modules.bnn.modules.base import _BayesModule
+from modules.bnn.utils import to_numpy, device
+
+
+class _MemberForward(nn.Module):
+    # model output and regulariser of one member, so functional_call swaps the parameters
+    # the kl sees as well as those of the forward pass
+    def __init__(self, model, kl_loss):
+        super(_MemberForward, self).__init__()
+        self.model = model
+        self.kl_loss = kl_loss
+
+    def forward(self, x):
+        return self.model(x), self.kl_loss(self.model)
+
+
+class StackedBNN(nn.Module):
+    """N independent BNNs of the same architecture (e.g. different seeds, folds, priors)
+       trained as one model. Their parameters and prior buffers are stacked along a leading
+       member dimension and the forward pass and KL of all members run in one vmapped call,
+       so a single optimiser step updates every member. The optimisers used in this repo
+       are elementwise (Adam), so one optimiser over the stacked parameters trains each
+       member exactly as if it had its own.
+    """
+    def __init__(self, models, kl_loss):
+        super(StackedBNN, self).__init__()
+        for model in models:
+            for m in model.modules():
+                if getattr(m, '_flat_views', None):
+                    raise ValueError("StackedBNN needs models without a flat parameter store")
+                if isinstance(m, _BayesModule) and (m.noise != 'iid' or getattr(m, 'sampling', None) == 'fused'):
+                    raise ValueError("StackedBNN supports iid noise and the 'weight', 'local' and 'flipout' sampling")
+        self.models = models
+        params, buffers = stack_module_state(models)
+        self._param_names = list(params)
+        self.stacked_params = nn.ParameterList([nn.Parameter(params[name]) for name in self._param_names])
+        # registered, so .to()/.double() move the stacked priors along with the parameters
+        self._buffer_names = list(buffers)
+        for i, name in enumerate(self._buffer_names):
+            self.register_buffer(f'stacked_buffer{i}', buffers[name])
+
+        # stateless copy the stacked tensors are swapped into, with the std cache disabled; kept
+        # in a tuple so it is not a submodule and its own tensors stay out of parameters()/state_dict()
+        template = copy.deepcopy(models[0])
+        for m in template.modules():
+            if isinstance(m, _BayesModule):
+                m._std_cache = None
+        self._member = (_MemberForward(template, kl_loss),)
+
+    def __len__(self):
+        return len(self.models)
+
+    def _forward_member(self, params, buffers, x):
+        state = {'model.' + name: tensor for name, tensor in zip(self._param_names, params)}
+        state.update({'model.' + name: tensor for name, tensor in zip(self._buffer_names, buffers)})
+        return functional_call(self._member[0], state, (x,))
+
+    def forward(self, x):
+        """
+        x of shape (N, batch_size, in_features), one minibatch per member. Returns the
+        outputs (N, batch_size, out_features) and the KL of every member, (N,).
+        """
+        buffers = tuple(getattr(self, f'stacked_buffer{i}') for i in range(len(self._buffer_names)))
+        return vmap(self._forward_member, randomness='different')(tuple(self.stacked_params), buffers, x)
+
+    def unstack(self):
+        """
+        Copy the trained stacked parameters back into the member models and return them.
+        """
+        with torch.no_grad():
+            for i, model in enumerate(self.models):
+                member_params = dict(model.named_parameters())
+                for name, param in zip(self._param_names, self.stacked_params):
+                    member_params[name].copy_(param[i])
+        return self.models
+
+
+def _member_nll(nll_loss, y_pred, y, beta=None):
+    # per member nll, applying the loss elementwise to the flattened members and minibatches
+    member_loss = copy.copy(nll_loss)
+    reduction, member_loss.reduction = nll_loss.reduction, 'none'
+    loss_args = (y_pred.flatten(0, 1), y.flatten(0, 1))
+    if beta is not None:
+        loss_args = loss_args + (beta.flatten(0, 1),)
+    loss = member_loss(*loss_args).reshape(y_pred.shape[0], -1)
+    return loss.mean(1) if reduction == 'mean' else loss.sum(1)
+
+
+def stacked_train_step(stacked, opt, nelbo, dataloaders, log_noise_vars, device=device):
+    """
+    Minibatch gradient descent through the training sets of all members at once, the
+    members' loaders must yield minibatches of the same shapes. log_noise_vars holds the
+    log likelihood variance of every member, (N,), or is None.
+    Returns the per member summed loss, nll and kl as detached (N,) tensors on the device.
+    """
+    tloss, tnll, tkl = 0,0,0
+    num_data = torch.tensor([len(loader.dataset) for loader in dataloaders], device=device)
+    for batches in zip(*dataloaders):
+        opt.zero_grad()
+        if len({tuple(x.shape) for x, _ in batches}) > 1:
+            raise ValueError("the members' minibatches must have the same shape")
+        batch_size = batches[0][0].shape[0]
+        minibatch_ratio = batch_size / num_data
+        x = torch.stack([x.to(device).reshape((batch_size, -1)) for x, _ in batches])
+        y = torch.stack([y.to(device) for _, y in batches])
+        y_pred, kl = stacked(x)
+        if log_noise_vars is None:
+            nll = _member_nll(nelbo.nll_loss, y_pred, y)
+        else:
+            beta = torch.exp(log_noise_vars)[:, None].expand(len(batches), batch_size)
+            nll = _member_nll(nelbo.nll_loss, y_pred, y, beta)
+        kl = kl * minibatch_ratio
+        loss = nll + kl
+        # members are independent, so the gradient of the sum is each member's own gradient
+        loss.sum().backward()
+        opt.step()
+        tloss += loss.detach(); tnll += nll.detach(); tkl += kl.detach()
+    return tloss, tnll, tkl
+
+
+def stacked_training_loop(stacked, N_epochs, opt, lr_sch, nelbo, train_loaders, log_lik_vars=None,
+                          device=device, log_every=1000):
+    """
+    training_loop for a StackedBNN, train_loaders holding one loader per member. Returns
+    the logs of shape (num_logs, N, 4), [epoch, nelbo, nll, kl] of every member averaged
+    over the last log_every epochs; call stacked.unstack() for the trained models.
+    """
+    stacked.train()
+    logs = []
+    loss_sums = 0
+    for i in range(N_epochs):
+        loss, nll, kl = stacked_train_step(stacked, opt, nelbo, train_loaders, log_lik_vars, device)
+        loss_sums = loss_sums + torch.stack([loss, nll, kl], 1)
+        lr_sch.step()
+        if (i+1) % log_every == 0:
+            avg = to_numpy(loss_sums / log_every)
+            loss_sums = 0
+            logs.append(np.concatenate([np.full((len(stacked), 1), i+1), avg], 1))
+            print("Epoch {}, nelbo={}, nll={}, kl={}".format(i+1, *avg.mean(0)))
+    return np.array(logs)
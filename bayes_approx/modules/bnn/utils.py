@@ -1,8 +1,10 @@
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
 import csv
 import os
+import random
+import time
+import torch.nn as nn
 import torch.nn.functional as F
 # import torchviz as tv
 
@@ -12,6 +14,11 @@ from modules.bnn.modules.ext_emp_linear import ExtEmpBayesLinear
 from modules.bnn.modules.cm_linear import CMBayesLinear
 from modules.bnn.modules.cmv_linear import CMVBayesLinear
 from modules.bnn.modules.mlg_linear import MLGBayesLinear
+from modules.bnn.modules.conv import BayesConv2d, EmpBayesConv2d
+from modules.bnn.modules.sequential import BayesSequential
+from modules.bnn.modules.ensemble import SampledEnsemble
+from modules.bnn.modules.base import _BayesModule, posterior_mean, noise_source
+import modules.bnn.functional as BF
 
 
 device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
@@ -24,35 +31,209 @@ def to_numpy(x):
 
 # Methods below are for single ELBO objectives
 def training_loop(model, N_epochs, opt, lr_sch, nelbo, train_loader, test_loader, beta,
-                  test_step=None, train=None, filename=None, device=device):
+                  test_step=None, train=None, filename=None, device=device, test_predict=None,
+                  log_every=1000, checkpoint_every=None, resume=False, stopping=None):
+    """
+    test_predict is the predict function used by test_step at every log, e.g. predict_wo_var
+    for a cheap single pass check with the posterior mean instead of a 50 sample MC estimate,
+    or functools.partial(predict, tol=1e-2) to stop sampling once the estimates have converged
+    (the test steps then report the number of samples used).
+    The epoch losses are summed on the device and only read back every log_every epochs, when
+    their averages are logged.
+    With a filename, a checkpoint of the model, optimiser, scheduler, RNG states and logs is
+    written every checkpoint_every epochs (default log_every), and resume=True continues a
+    run from the checkpoint of the same filename exactly as if it had not been interrupted.
+    stopping is an EarlyStopping policy checked at every log, the best model it has seen is
+    restored when training ends.
+    """
+    if test_predict is None:
+        test_predict = predict
+    if checkpoint_every is None:
+        checkpoint_every = log_every
     model.train()
     logs = []
-    losses = []; nlls = []; kls = []
-    for i in range(N_epochs):
+    loss_sums = 0
+    start = 0
+    if filename is not None and resume and os.path.exists(checkpoint_path(filename)):
+        start, logs, loss_sums = load_checkpoint(
+            checkpoint_path(filename), model, opt, lr_sch, beta, device, stopping
+        )
+        print(f'Resuming {filename} from epoch {start}')
+    if stopping is not None:
+        stopping.start()
+        if stopping.reason is not None:
+            # the checkpointed run had already stopped
+            start = N_epochs
+    for i in range(start, N_epochs):
         # train step is whole training dataset (minibatched inside function)
         loss, nll, kl = train_step(model, opt, nelbo, train_loader, beta, device)
-        losses.append(float(loss))
-        nlls.append(float(nll))
-        kls.append(float(kl))
+        loss_sums = loss_sums + torch.stack([loss, nll, kl])
         lr_sch.step()
-        if (i+1) % 1000 == 0:
+        if (i+1) % log_every == 0:
             # print(beta)
-            avgloss = sum(losses[-1000:])/1000
-            avgnll = sum(nlls[-1000:])/1000
-            avgkl = sum(kls[-1000:])/1000
+            avgloss, avgnll, avgkl = (loss_sums / log_every).tolist()
+            loss_sums = 0
             logs = logging(model, logs, i, avgloss, avgnll, avgkl, beta)
-            logs[-1].append(to_numpy(test_step(model, test_loader, train, predict, log_lik_var=beta)))
+            logs[-1].append(to_numpy(test_step(model, test_loader, train, test_predict, log_lik_var=beta)))
             if filename is not None:
                 torch.save(model.state_dict(), f'bayes_approx/saved_models/{filename}.pt')
                 write_logs_to_file(logs, filename)
-
+            if stopping is not None:
+                stopping.update(model, beta, avgloss, float(logs[-1][-1]))
+        stop = stopping is not None and stopping.should_stop()
+        if filename is not None and ((i+1) % checkpoint_every == 0 or stop):
+            save_checkpoint(checkpoint_path(filename), i+1, model, opt, lr_sch, logs, loss_sums, beta, stopping)
+        if stop:
+            print(f'Stopping at epoch {i+1}: {stopping.reason}')
+            break
+
+    if stopping is not None and stopping.restore(model, beta) and filename is not None:
+        torch.save(model.state_dict(), f'bayes_approx/saved_models/{filename}.pt')
     logs = np.array(logs)
     return logs
 
 
+def checkpoint_path(filename):
+    return f'bayes_approx/saved_models/{filename}_checkpoint.pt'
+
+
+def save_checkpoint(path, epoch, model, opt, lr_sch, logs, loss_sums, beta=None, stopping=None):
+    """
+    Save the training state after epoch epochs. The checkpoint is written to a temporary
+    file that then replaces the old one, so a run killed mid-write leaves the last
+    checkpoint intact.
+    """
+    state = {
+        'epoch': epoch,
+        'model': model.state_dict(),
+        'opt': opt.state_dict(),
+        'lr_sch': lr_sch.state_dict(),
+        'logs': logs,
+        'loss_sums': loss_sums,
+        # the likelihood variance is trained with the model in the empirical Bayes experiments
+        'beta': beta.detach().clone() if torch.is_tensor(beta) else None,
+        'stopping': stopping.state_dict() if stopping is not None else None,
+        'rng': {
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy': np.random.get_state(),
+            'random': random.getstate(),
+        },
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, model, opt, lr_sch, beta=None, device=device, stopping=None):
+    """
+    Restore the training state saved by save_checkpoint into model, opt, lr_sch (beta and
+    the stopping policy) and the RNGs. Returns the number of epochs done, the logs and the running loss sums.
+    """
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    model.load_state_dict(state['model'])
+    opt.load_state_dict(state['opt'])
+    lr_sch.load_state_dict(state['lr_sch'])
+    if torch.is_tensor(beta) and state['beta'] is not None:
+        with torch.no_grad():
+            beta.copy_(state['beta'])
+    if stopping is not None and state.get('stopping') is not None:
+        stopping.load_state_dict(state['stopping'])
+    torch.set_rng_state(state['rng']['torch'])
+    if state['rng']['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['rng']['cuda'])
+    np.random.set_state(state['rng']['numpy'])
+    random.setstate(state['rng']['random'])
+    loss_sums = state['loss_sums']
+    if torch.is_tensor(loss_sums):
+        loss_sums = loss_sums.to(device)
+    return state['epoch'], state['logs'], loss_sums
+
+
+class EarlyStopping:
+    """Stopping policy for training_loop, updated at every log with the nelbo averaged over
+       the last log_every epochs and the test_step result (lower is better):
+         rel_tol: stop once the nelbo improved by less than rel_tol (relative) over the
+                  last window logs
+         patience: stop after patience logs without a new best test_step result
+         max_time: stop after max_time seconds of training (summed over resumed runs)
+       The model (and a learnable beta) with the best test_step result if patience is set,
+       otherwise with the lowest nelbo, is kept and restored when training ends, e.g.
+           training_loop(..., log_every=500, stopping=EarlyStopping(rel_tol=1e-3, window=4))
+    """
+    def __init__(self, rel_tol=None, window=5, patience=None, max_time=None):
+        self.rel_tol = rel_tol
+        self.window = window
+        self.patience = patience
+        self.max_time = max_time
+        self.nelbos = []
+        self.best_score = float('inf')
+        self.best_state = None
+        self.num_bad_logs = 0
+        self.elapsed = 0.
+        self.reason = None
+        self._start_time = None
+
+    def start(self):
+        self._start_time = time.perf_counter()
+
+    def _time(self):
+        if self._start_time is None:
+            return self.elapsed
+        return self.elapsed + time.perf_counter() - self._start_time
+
+    def update(self, model, beta, nelbo, test_score):
+        self.nelbos.append(nelbo)
+        score = test_score if self.patience is not None else nelbo
+        if score < self.best_score:
+            self.best_score = score
+            self.num_bad_logs = 0
+            self.best_state = {
+                'model': {k: v.detach().clone() for k, v in model.state_dict().items()},
+                'beta': beta.detach().clone() if torch.is_tensor(beta) else None,
+            }
+        else:
+            self.num_bad_logs += 1
+
+    def should_stop(self):
+        if self.rel_tol is not None and len(self.nelbos) > self.window:
+            old, new = self.nelbos[-self.window - 1], self.nelbos[-1]
+            if (old - new) / abs(old) < self.rel_tol:
+                self.reason = f'nelbo improved by less than {self.rel_tol} over {self.window} logs'
+        if self.patience is not None and self.num_bad_logs >= self.patience:
+            self.reason = f'no test improvement for {self.patience} logs'
+        if self.max_time is not None and self._time() >= self.max_time:
+            self.reason = f'time budget of {self.max_time}s used'
+        return self.reason is not None
+
+    def restore(self, model, beta=None):
+        """
+        Load the best state into model (and beta), returns whether there was one.
+        """
+        if self.best_state is None:
+            return False
+        model.load_state_dict(self.best_state['model'])
+        if torch.is_tensor(beta) and self.best_state['beta'] is not None:
+            with torch.no_grad():
+                beta.copy_(self.best_state['beta'])
+        return True
+
+    def state_dict(self):
+        state = {k: v for k, v in self.__dict__.items() if k != '_start_time'}
+        state['elapsed'] = self._time()
+        return state
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
+
 def train_step(model, opt, nelbo, dataloader, log_noise_var, device=device):
     """
     Minibatch gradient descent through entire training batch.
+    Returns the summed loss, nll and kl as detached 0-d tensors on the device.
     """
     tloss, tnll, tkl = 0,0,0
     for _, (x, y) in enumerate(dataloader):
@@ -70,7 +251,9 @@ def train_step(model, opt, nelbo, dataloader, log_noise_var, device=device):
         loss, nll, kl = nelbo(model, loss_args, minibatch_ratio)
         loss.backward()
         opt.step()
-        tloss += loss; tnll += nll; tkl += kl
+        # detached, so the graph of every minibatch is freed once its step is done
+        # summed to 0-d, so a regulariser returning shape (1,) still logs scalars
+        tloss += loss.detach().sum(); tnll += nll.detach().sum(); tkl += kl.detach().sum()
         # g = tv.make_dot(loss, params=dict(model.named_parameters()))
         # g.filename = 'network.dot'
         # g.render()
@@ -101,21 +284,135 @@ def train_step(model, opt, nelbo, dataloader, log_noise_var, device=device):
 #     ))
 
 
-def predict(model, x, K=50, device=device):
+def predict(model, x, K=50, device=device, noise=None, tol=None, sample_chunk=None, input_chunk=None):
     """
     Monte Carlo sampling of BNN using K samples.
+    Models built with BayesSequential draw all K samples in a single vectorised forward pass,
+    a SampledEnsemble reuses its frozen samples (K of them picked at random if K is smaller).
+    noise overrides the noise source of the layers for this call ('antithetic' or 'sobol'
+    reduce the variance of the estimates for a given K, see modules.bnn.noise).
+    With tol set, samples are drawn adaptively (see predict_adaptive), K is the maximum and
+    the number of samples used is returned as a third value.
+    With sample_chunk/input_chunk set, the moments are accumulated over chunks of samples and
+    inputs (see predict_streaming) instead of from all K outputs at once.
     """
+    if noise is not None and not isinstance(model, SampledEnsemble):
+        with noise_source(model, noise):
+            return predict(model, x, K, device, tol=tol, sample_chunk=sample_chunk, input_chunk=input_chunk)
+
+    if tol is not None and K > 1 and not isinstance(model, SampledEnsemble):
+        return predict_adaptive(model, x, tol, max_K=K, device=device)
+
+    if sample_chunk is not None or input_chunk is not None:
+        y_pred_mean, y_pred_var = predict_streaming(model, x, K, sample_chunk, input_chunk, device=device)
+        return y_pred_mean, y_pred_var.sqrt()
+
+    if isinstance(model, SampledEnsemble):
+        y_pred = model(x.to(device), num_samples=K)
+        if K == 1:
+            return y_pred[0], torch.tensor([0])
+        return y_pred.mean(0), y_pred.std(0)
+
     if K == 1:
         return model(x.to(device)), torch.tensor([0])
 
-    y_pred = []
-    for _ in range(K):
-        y_pred.append(model(x.to(device)))
-    # shape (K, batch_size, y_dim) or (batch_size, y_dim) if K = 1
-    y_pred = torch.stack(y_pred, dim=0).squeeze(0)
+    y_pred = _predictive_samples(model, x.to(device), K)
+    # shape (K, batch_size, y_dim)
     return y_pred.mean(0), y_pred.std(0)
 
 
+def _predictive_samples(model, x, K):
+    if isinstance(model, BayesSequential):
+        return model(x, num_samples=K)
+    return torch.stack([model(x) for _ in range(K)], dim=0)
+
+
+def predict_adaptive(model, x, tol=1e-2, max_K=200, batch_K=10, device=device):
+    """
+    Monte Carlo sampling of BNN with an adaptive number of samples.
+    Samples are drawn batch_K at a time and merged into a running mean and variance (Welford,
+    batched form of Chan et al.) until the largest standard error of the predictive mean and
+    std, std/sqrt(n) and std/sqrt(2(n-1)), is below tol, or max_K samples have been drawn.
+    Returns the predictive mean, std and the number of samples used.
+    """
+    x = x.to(device)
+    moments = RunningMoments()
+    while moments.count < max_K:
+        moments.update(_predictive_samples(model, x, min(batch_K, max_K - moments.count)))
+        n = moments.count
+        if n > 1:
+            se_mean = (moments.var / n).sqrt().max()
+            se_std = (moments.var / (2 * (n - 1))).sqrt().max()
+            if max(se_mean, se_std) < tol:
+                break
+    return moments.mean, moments.std, moments.count
+
+
+def predict_streaming(model, x, K=50, sample_chunk=None, input_chunk=None, softmax=False, device=device):
+    """
+    Predictive mean and variance of K samples (of the softmax probabilities if softmax=True),
+    accumulated online over chunks of sample_chunk samples and input_chunk inputs, so at most
+    a (sample_chunk, input_chunk, y_dim) tensor of outputs is held at once whatever K and the
+    number of inputs.
+    """
+    x = x.to(device)
+    means, variances = [], []
+    for x_chunk in x.split(input_chunk or max(x.shape[0], 1)):
+        moments = RunningMoments()
+        for y_pred in _sample_chunks(model, x_chunk, K, sample_chunk):
+            moments.update(F.softmax(y_pred, dim=-1) if softmax else y_pred)
+        means.append(moments.mean)
+        variances.append(moments.var)
+    return torch.cat(means), torch.cat(variances)
+
+
+def _sample_chunks(model, x, K, sample_chunk=None):
+    # the K predictive samples of model at x, sample_chunk of them at a time
+    chunk = sample_chunk or K
+    if isinstance(model, SampledEnsemble):
+        if K > model.num_samples:
+            raise ValueError(f'the ensemble holds {model.num_samples} samples, got K={K}')
+        index = torch.randperm(model.num_samples)[:K] if K < model.num_samples else torch.arange(K)
+        for start in range(0, K, chunk):
+            yield model(x, sample_index=index[start:start + chunk])
+    else:
+        for start in range(0, K, chunk):
+            yield _predictive_samples(model, x, min(chunk, K - start))
+
+
+class RunningMoments:
+    """Running mean and (unbiased) variance over the leading sample dimension of the batches
+       passed to update, merged with the batched Welford update of Chan et al.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def update(self, samples):
+        k = samples.shape[0]
+        batch_mean = samples.mean(0)
+        batch_m2 = ((samples - batch_mean)**2).sum(0)
+        if self.count == 0:
+            self.mean, self._m2 = batch_mean, batch_m2
+        else:
+            n = self.count
+            delta = batch_mean - self.mean
+            self.mean = self.mean + delta * k / (n + k)
+            self._m2 = self._m2 + batch_m2 + delta**2 * n * k / (n + k)
+        self.count += k
+
+    @property
+    def var(self):
+        if self.count < 2:
+            return torch.zeros_like(self.mean)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return self.var.sqrt()
+
+
 # # Methods below are for seperate training and model selection objectives
 # def ml_sep_training_loop(model, N_epochs, nn_opt, ml_opt, map_loss, ml_loss,
 #                          train_loader, test_loader, filename, device=device):
@@ -169,13 +466,13 @@ def logging(model, logs, i, loss, nll, prior_reg, beta=None, ml_loss=None):
     loss_logs = [i+1, loss, nll, prior_reg]
     if ml_loss is not None:
         loss_logs.append(to_numpy(ml_loss))
-    first_layer = list(model.modules())[1]
-    if isinstance(first_layer, (BayesLinear)):
+    first_layer = next((m for m in model.modules() if isinstance(m, _BayesModule)), list(model.modules())[1])
+    if isinstance(first_layer, (BayesLinear, BayesConv2d)):
         logs.append(loss_logs)
         print("Epoch {}, nelbo={}, nll={}, kl={}".format(
             logs[-1][0], logs[-1][1], logs[-1][2], logs[-1][3]
         ))
-    elif isinstance(first_layer, (EmpBayesLinear)):
+    elif isinstance(first_layer, (EmpBayesLinear, EmpBayesConv2d)):
         prior_std = np.log(1 + np.exp(to_numpy(model._prior_std_param)))
         if beta.requires_grad:
             logs.append(loss_logs + [prior_std] + [*to_numpy(beta)])
@@ -226,6 +523,7 @@ def logging(model, logs, i, loss, nll, prior_reg, beta=None, ml_loss=None):
 
 
 def plot_training_loss(logs, exp_name=None):
+    import matplotlib.pyplot as plt  # imported on first use, training does not need it
     fig, axs = plt.subplots(2, 2)
     axs[0,0].plot(np.arange(logs.shape[0]), logs[:,1], 'r-')
     axs[0,1].plot(np.arange(logs.shape[0]), logs[:,2], 'r-')
@@ -246,6 +544,7 @@ def plot_training_loss(logs, exp_name=None):
 
 
 def plot_training_loss_together(logs, title='training curve', exp_name=None):
+    import matplotlib.pyplot as plt
     x = np.arange(logs.shape[0])*1000
     plt.plot(x, logs[:,1], 'r-', label='nelbo')
     plt.fill_between(x, logs[:,2], label='nll')
@@ -281,7 +580,52 @@ def uniquify(name):
 
 
 def predict_wo_var(model, x_test, device=device, **kwargs):
-    return model(x_test.to(device), variance=False)
+    """
+    Single deterministic forward pass with the posterior mean weights.
+    Returns a zero std so it can be used in place of predict (e.g. in mse_test_step).
+    """
+    with posterior_mean(model):
+        y_pred = model(x_test.to(device))
+    return y_pred, torch.zeros_like(y_pred)
+
+
+def predict_moments(model, x, device=device):
+    """
+    Sampling-free prediction by propagating the mean and variance of every unit through the
+    network: Bayesian layers give the exact moments of their outputs for independent inputs,
+    ReLU/LeakyReLU use the rectified Gaussian moments (activations are assumed Gaussian and
+    independent). Returns the predictive mean and variance, shape (batch_size, y_dim),
+    computed without building an autograd graph.
+    """
+    for layer in model:
+        if isinstance(layer, _BayesModule) and not layer.propagates_moments:
+            raise TypeError(f'moments cannot be propagated through {type(layer).__name__}')
+    with torch.no_grad():
+        mean, var = x.to(device), None
+        for layer in model:
+            if isinstance(layer, _BayesModule):
+                mean, var = layer._output_moments(mean, var)
+            elif isinstance(layer, (nn.ReLU, nn.LeakyReLU)):
+                negative_slope = getattr(layer, 'negative_slope', 0.)
+                if var is None:
+                    mean = layer(mean)
+                else:
+                    mean, var = BF._relu_moments(mean, var, negative_slope)
+            elif isinstance(layer, (nn.Flatten, nn.Unflatten, nn.Identity)):
+                mean = layer(mean)
+                var = None if var is None else layer(var)
+            else:
+                raise TypeError(f'moments cannot be propagated through {type(layer).__name__}')
+        return mean, torch.zeros_like(mean) if var is None else var
+
+
+def predict_wo_sampling(model, x_test, device=device, **kwargs):
+    """
+    predict_moments returning the predictive std, so it can be used in place of predict
+    (e.g. in get_regression_results or mse_test_step) at the cost of one forward pass.
+    """
+    y_pred_mean, y_pred_var = predict_moments(model, x_test, device)
+    return y_pred_mean, y_pred_var.sqrt()
 
 
 def load_model(model, model_name):